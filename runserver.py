@@ -1,25 +1,163 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
+import os
+import time
+import errno
+import signal
+import logging
 import tornado.web
 import tornado.ioloop
 import tornado.options
+import tornado.process
+import tornado.netutil
 import tornado.httpserver
 from tornado.options import define, options
 
 from webgear5 import Application
-from webgear5.settings import settings
+from webgear5.settings import settings, init_connections, jinja_environment
+from webgear5.extensions.templates import preload
+from webgear5.models.topic import Topic
+from webgear5.models.member import Member
+from webgear5.models.member_index import MemberIndex
+from webgear5.models.ranking import PosterRanking
+from webgear5.models.view_counter import ViewCounter
 
 define("port", default=8080, type=int)
 define("autoreload", default=True, type=bool)
+define("processes", default=1, type=int, help="number of worker processes, 0 = one per cpu")
+define("reuse_port", default=False, type=bool, help="bind a SO_REUSEPORT socket in every worker")
+define("max_restarts", default=100, type=int, help="stop after this many worker crashes")
+
+
+def serve(sockets=None):
+    """Run one server on the current process until SIGTERM/SIGINT"""
+    io_loop = tornado.ioloop.IOLoop.instance()
+    http_server = tornado.httpserver.HTTPServer(Application())
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(options.port, reuse_port=options.reuse_port)
+    http_server.add_sockets(sockets)
+
+    #buffered topic views are written to Mongo periodically and on shutdown
+    flush_views = tornado.ioloop.PeriodicCallback(
+        ViewCounter.flush, settings['views_flush_interval'] * 1000, io_loop=io_loop)
+    flush_views.start()
+
+    def stop():
+        http_server.stop()
+        flush_views.stop()
+        ViewCounter.flush()
+        io_loop.stop()
+
+    def on_signal(signum, frame):
+        io_loop.add_callback_from_signal(stop)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    io_loop.start()
+
+
+def spawn_worker(sockets):
+    pid = os.fork()
+    if pid:
+        return pid
+
+    #child: reset the supervisor signal handlers and open our own connections
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    code = 0
+    try:
+        init_connections()
+        serve(sockets)
+    except Exception:
+        logging.exception('worker %d crashed', os.getpid())
+        code = 1
+    finally:
+        os._exit(code)
+
+
+def supervise(sockets, num_processes, max_restarts=100):
+    """
+    Fork workers, restart the crashed ones and stop all of them on SIGTERM.
+    Restarts wait longer after each crash in a row (up to 30s) and the
+    supervisor gives up after `max_restarts` crashes, like tornado's
+    fork_processes.
+    """
+    children = set(spawn_worker(sockets) for _ in range(num_processes))
+    stopping = []
+    restarts = 0
+    delay, last_crash = 0, 0
+
+    def shutdown(signum, frame):
+        stopping.append(signum)
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        children.remove(pid)
+
+        if stopping:
+            continue
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            logging.info('worker %d exited', pid)
+            continue
+
+        restarts += 1
+        if restarts > max_restarts:
+            logging.error('worker %d died (status %d), too many restarts, stopping', pid, status)
+            shutdown(signal.SIGTERM, None)
+            continue
+        #crashes more than a minute apart start the backoff again
+        now = time.time()
+        delay = min(delay * 2, 30) if now - last_crash < 60 else 0.1
+        last_crash = now
+        logging.warning('worker %d died (status %d), restarting in %.1fs', pid, status, delay)
+        time.sleep(delay)
+        if not stopping:
+            children.add(spawn_worker(sockets))
 
 
 def main():
     tornado.options.parse_command_line()
+    num_processes = options.processes or tornado.process.cpu_count()
     print '... server started on port %s ...' % options.port
     print '... debug mode: %s' % settings.get('debug', True)
-    http_server = tornado.httpserver.HTTPServer(Application())
-    http_server.listen(options.port)
-    tornado.ioloop.IOLoop.instance().start()
+    if not settings.get('debug', True):
+        #before forking, so the workers share the compiled templates
+        print '... %d templates loaded ...' % preload(jinja_environment)
+    Topic.ensure_indexes()
+    #the member search index and poster rankings are built once, never while serving requests
+    if Member.ensure_backfilled():
+        print '... member lookup fields backfilled ...'
+    if MemberIndex.ensure_built():
+        print '... member search index built ...'
+    if PosterRanking.ensure_built():
+        print '... poster rankings built ...'
+
+    if num_processes == 1:
+        serve()
+        return
+
+    print '... %d worker processes ...' % num_processes
+    #autoreload can not watch forked workers
+    settings['autoreload'] = False
+    sockets = None
+    if not options.reuse_port:
+        sockets = tornado.netutil.bind_sockets(options.port)
+    supervise(sockets, num_processes, options.max_restarts)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,12 +1,28 @@
 # -*- coding: utf-8 -*-
+import os
+import time
 import uuid
 import hashlib
 import inspect
+import logging
+import binascii
+import threading
 import exceptions
 import functools
 import warnings
 import redis_cache
 from types import NoneType
+from tornado import gen
+from tornado.concurrent import Future
+from local_cache import LocalCache
+
+#: seconds between two checks while another caller recomputes a value
+LOCK_POLL_INTERVAL = 0.01
+#memoize version hashes never expire, see _memoize_version
+VERSION_TIMEOUT = 0
+#key of the freshness deadline in soft timeout values, a dict comes back as
+#a dict from every serializer while msgpack turns tuples into lists
+SOFT_KEY = '__fresh_until__'
 
 
 def function_namespace(f, args=None):
@@ -29,6 +45,35 @@ def function_namespace(f, args=None):
         return '%s.%s' % (f.__module__, f.__name__)
 
 
+def compile_key_args(f):
+    """
+    Generates a function that maps the call arguments of `f` to the tuple
+    `Cache.memoize_kwargs_to_args` would build, without inspecting `f` again.
+    """
+    argspec = inspect.getargspec(f)
+    args_len = len(argspec.args)
+    defaults = argspec.defaults or ()
+
+    items = []
+    for i, name in enumerate(argspec.args):
+        if i == 0 and name in ('self', 'cls'):
+            items.append('repr(args[0])')
+            continue
+        if i >= args_len - len(defaults):
+            default = '_defaults[%d]' % (i - args_len + len(defaults))
+        else:
+            default = 'None'
+        items.append('kwargs[%r] if %r in kwargs else args[%d] if n > %d else %s' % (
+            name, name, i, i, default))
+
+    source = 'def key_args(args, kwargs):\n' \
+             '    n = len(args)\n' \
+             '    return (%s)\n' % ''.join('%s, ' % item for item in items)
+    namespace = {'_defaults': defaults}
+    exec compile(source, '<key_args %s>' % f.__name__, 'exec') in namespace
+    return namespace['key_args']
+
+
 class Cache(object):
     """
     This class is used to control the cache objects.
@@ -38,6 +83,11 @@ class Cache(object):
 
     def __init__(self, config=None):
         self.config = config
+        self._local_caches = {}
+        self._versions = {}
+        self._version_generation = 0
+        self._listener_pid = None
+        self._subscribed = False
         self.init_app(config)
 
     def init_app(self, config=None):
@@ -56,6 +106,14 @@ class Cache(object):
         config.setdefault('CACHE_ARGS', [])
         config.setdefault('CACHE_TYPE', 'redis')
         config.setdefault('CACHE_NO_NULL_WARNING', False)
+        config.setdefault('CACHE_LOCAL_ENABLED', False)
+        config.setdefault('CACHE_LOCAL_THRESHOLD', 500)
+        config.setdefault('CACHE_LOCAL_TIMEOUT', 30)
+        config.setdefault('CACHE_INVALIDATION_CHANNEL', config['CACHE_KEY_PREFIX'] + 'memoize:invalidate')
+        config.setdefault('CACHE_SINGLE_FLIGHT', False)
+        config.setdefault('CACHE_LOCK_TIMEOUT', 10)
+        #callers run on the IOLoop, waiting for a lock holder blocks it
+        config.setdefault('CACHE_LOCK_WAIT', 0.05)
 
         if config['CACHE_TYPE'] == 'null' and not config['CACHE_NO_NULL_WARNING']:
             warnings.warn("CACHE_TYPE is set to null, "
@@ -80,11 +138,80 @@ class Cache(object):
 
         self.app.setdefault('cache', {})
         self.app['cache'][self] = cache_obj(config, cache_args, cache_options)
+        self._listener_pid = None
+        self._subscribed = False
+        self._invalidate_local('*')
 
     @property
     def cache(self):
         return self.app['cache'][self]
 
+    def _local_cache(self, fname, threshold=None, timeout=None):
+        """Returns the in-process cache tier of a memoized function."""
+        local_cache = self._local_caches.get(fname)
+        if local_cache is None:
+            local_cache = LocalCache(threshold or self.config['CACHE_LOCAL_THRESHOLD'],
+                                     timeout or self.config['CACHE_LOCAL_TIMEOUT'])
+            self._local_caches[fname] = local_cache
+        self._subscribe()
+        return local_cache
+
+    def _subscribe(self):
+        """Starts the invalidation listener once per (forked) process."""
+        if self._listener_pid == os.getpid():
+            return
+        self._listener_pid = os.getpid()
+        listener = threading.Thread(target=self._listen, name='cache-invalidation')
+        listener.daemon = True
+        listener.start()
+
+    def _listen(self):
+        pid = os.getpid()
+        while self._listener_pid == pid:
+            try:
+                pubsub = self.cache._client.pubsub()
+                pubsub.subscribe(self.config['CACHE_INVALIDATION_CHANNEL'])
+                #messages may have been missed while we were not subscribed
+                self._invalidate_local('*')
+                self._subscribed = True
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._invalidate_local(*message['data'].split(' ', 1))
+            except Exception:
+                self._subscribed = False
+                logging.warning('Cache invalidation listener lost Redis connection.')
+                time.sleep(1)
+
+    def _invalidate_local(self, fname, key=None):
+        #every invalidation starts a new generation, a value read before it
+        #is neither kept as version nor written back to a local tier
+        self._version_generation += 1
+        if fname == '*':
+            self._versions.clear()
+            for local_cache in self._local_caches.values():
+                local_cache.clear()
+            return
+
+        if not key:
+            self._versions.pop(fname, None)
+
+        local_cache = self._local_caches.get(fname)
+        if local_cache is None:
+            return
+        if key:
+            local_cache.delete(key)
+        else:
+            local_cache.clear()
+
+    def _publish_invalidation(self, fname, key=None):
+        """Drops local entries here and in every other process."""
+        self._invalidate_local(fname, key)
+        message = '%s %s' % (fname, key) if key else fname
+        try:
+            self.cache._client.publish(self.config['CACHE_INVALIDATION_CHANNEL'], message)
+        except Exception:
+            logging.warning('Can not publish cache invalidation for %s.', fname)
+
     def get(self, *args, **kwargs):
         """Proxy function for internal cache object."""
         return self.cache.get(*args, **kwargs)
@@ -108,6 +235,7 @@ class Cache(object):
     def clear(self):
         """Proxy function for internal cache object."""
         self.cache.clear()
+        self._publish_invalidation('*')
 
     def get_many(self, *args, **kwargs):
         """Proxy function for internal cache object."""
@@ -117,7 +245,30 @@ class Cache(object):
         """Proxy function for internal cache object."""
         self.cache.set_many(*args, **kwargs)
 
-    def cached(self, timeout=None, key_prefix='view/%s', unless=None):
+    def get_async(self, *args, **kwargs):
+        """Coroutine proxy function for internal cache object."""
+        return self.cache.get_async(*args, **kwargs)
+
+    def set_async(self, *args, **kwargs):
+        """Coroutine proxy function for internal cache object."""
+        return self.cache.set_async(*args, **kwargs)
+
+    def get_many_async(self, *args, **kwargs):
+        """Coroutine proxy function for internal cache object."""
+        return self.cache.get_many_async(*args, **kwargs)
+
+    def delete_async(self, *args, **kwargs):
+        """Coroutine proxy function for internal cache object."""
+        return self.cache.delete_async(*args, **kwargs)
+
+    def cached(self, timeout=None, key_prefix='view/%s', unless=None,
+               single_flight=None, soft_timeout=None):
+        """
+        Cache the return value of a view under `key_prefix`, see `memoize`
+        for `single_flight` and `soft_timeout`.
+        """
+        if single_flight is None:
+            single_flight = self.config['CACHE_SINGLE_FLIGHT']
 
         def decorator(f):
             @functools.wraps(f)
@@ -132,13 +283,8 @@ class Cache(object):
                 except Exception:
                     return f(*args, **kwargs)
 
-                if rv is None:
-                    rv = f(*args, **kwargs)
-                    try:
-                        self.cache.set(cache_key, rv, timeout=decorated_function.cache_timeout)
-                    except Exception:
-                        return f(*args, **kwargs)
-                return rv
+                return self._load(cache_key, rv, f, args, kwargs, decorated_function.cache_timeout,
+                                  single_flight, soft_timeout)
 
             def make_cache_key(*args, **kwargs):
                 if callable(key_prefix):
@@ -157,6 +303,95 @@ class Cache(object):
             return decorated_function
         return decorator
 
+    def _load(self, cache_key, rv, f, args, kwargs, timeout=None,
+              single_flight=False, soft_timeout=None):
+        """
+        Turns a backend read into the return value of `f`. Stale soft timeout
+        values are served while one caller refreshes them in the background,
+        with `single_flight` only one caller recomputes a missing value.
+        """
+        if rv is not None and soft_timeout:
+            fresh_until, rv = self._unwrap_soft(rv)
+            if fresh_until < time.time() and self._acquire_lock(cache_key):
+                refresh = threading.Thread(target=self._recompute,
+                                           args=(cache_key, f, args, kwargs, timeout, soft_timeout, True))
+                refresh.daemon = True
+                refresh.start()
+
+        if rv is not None:
+            return rv
+
+        locked = False
+        if single_flight or soft_timeout:
+            locked = self._acquire_lock(cache_key)
+            if not locked:
+                rv = self._wait_for(cache_key, soft_timeout)
+                if rv is not None:
+                    return rv
+
+        return self._recompute(cache_key, f, args, kwargs, timeout, soft_timeout, locked)
+
+    def _recompute(self, cache_key, f, args, kwargs, timeout=None, soft_timeout=None, locked=False):
+        try:
+            rv = f(*args, **kwargs)
+            try:
+                if soft_timeout:
+                    self.cache.set(cache_key, self._wrap_soft(rv, soft_timeout), timeout=timeout)
+                else:
+                    self.cache.set(cache_key, rv, timeout=timeout)
+            except Exception:
+                logging.warning('Can not store %s in the cache.', cache_key)
+            return rv
+        finally:
+            if locked:
+                self._release_lock(cache_key)
+
+    def _wrap_soft(self, rv, soft_timeout):
+        return {SOFT_KEY: time.time() + soft_timeout, 'value': rv}
+
+    def _unwrap_soft(self, rv):
+        """Splits a soft timeout value, plain values count as stale."""
+        if isinstance(rv, dict) and SOFT_KEY in rv:
+            return rv[SOFT_KEY], rv.get('value')
+        return 0, rv
+
+    def _lockname(self, cache_key):
+        return cache_key + '_lock'
+
+    def _acquire_lock(self, cache_key):
+        """Short lived lock, held while a single caller recomputes `cache_key`."""
+        try:
+            return bool(self.cache.add(self._lockname(cache_key), 1,
+                                       timeout=self.config['CACHE_LOCK_TIMEOUT']))
+        except Exception:
+            return False
+
+    def _release_lock(self, cache_key):
+        try:
+            self.cache.delete(self._lockname(cache_key))
+        except Exception:
+            pass
+
+    def _wait_for(self, cache_key, soft_timeout=None):
+        """
+        Waits at most ``CACHE_LOCK_WAIT`` seconds until the lock holder
+        stored the value or gave up the lock, returns None if the value did
+        not show up in time and the caller recomputes it itself.
+        """
+        lock_key = self._lockname(cache_key)
+        deadline = time.time() + self.config['CACHE_LOCK_WAIT']
+        while time.time() < deadline:
+            time.sleep(LOCK_POLL_INTERVAL)
+            try:
+                rv, locked = self.cache.get_many(cache_key, lock_key)
+            except Exception:
+                return None
+            if rv is not None:
+                return self._unwrap_soft(rv)[1] if soft_timeout else rv
+            if locked is None:
+                return None
+        return None
+
     def _memvname(self, funcname):
         return funcname + '_memver'
 
@@ -167,43 +402,128 @@ class Cache(object):
         """
         Function used to create the cache_key for memoized functions.
         """
-        def make_cache_key(f, *args, **kwargs):
-            fname = function_namespace(f, args)
+        make_base_key = self.memoize_make_base_key(make_name)
 
-            version_key = self._memvname(fname)
-            version_data = self.cache.get(version_key)
+        def make_cache_key(f, *args, **kwargs):
+            fname, cache_key = make_base_key(f, *args, **kwargs)
+            return cache_key + self._memoize_version(fname)
+        return make_cache_key
 
-            if version_data is None:
-                version_data = self.memoize_make_version_hash()
-                self.cache.set(version_key, version_data)
+    def _memoize_version(self, fname):
+        """
+        Returns the version hash of a memoized function. The local copy is
+        only trusted while the invalidation listener keeps it up to date.
+        """
+        self._subscribe()
+        version_data = self._versions.get(fname)
+        if version_data is not None and self._subscribed:
+            return version_data
+
+        generation = self._version_generation
+        version_key = self._memvname(fname)
+        version_data = self.cache.get(version_key)
+
+        if version_data is None:
+            #workers that keep versions locally rely on this key never expiring,
+            #a worker losing a concurrent first write uses the winner's version
+            version_data = self.memoize_make_version_hash()
+            if not self.cache.add(version_key, version_data, timeout=VERSION_TIMEOUT):
+                version_data = self.cache.get(version_key) or version_data
+
+        #an invalidation arrived while we were reading, do not keep it
+        if generation == self._version_generation:
+            self._versions[fname] = version_data
+        return version_data
+
+    @gen.coroutine
+    def _memoize_version_async(self, fname):
+        """Non-blocking `_memoize_version`."""
+        self._subscribe()
+        version_data = self._versions.get(fname)
+        if version_data is not None and self._subscribed:
+            raise gen.Return(version_data)
+
+        generation = self._version_generation
+        version_key = self._memvname(fname)
+        version_data = yield self.cache.get_async(version_key)
+
+        if version_data is None:
+            version_data = self.memoize_make_version_hash()
+            added = yield self.cache.add_async(version_key, version_data, timeout=VERSION_TIMEOUT)
+            if not added:
+                current = yield self.cache.get_async(version_key)
+                version_data = current or version_data
+
+        if generation == self._version_generation:
+            self._versions[fname] = version_data
+        raise gen.Return(version_data)
+
+    def _memoize_get(self, fname, base_key):
+        """
+        Looks up a memoized value, returns the cache_key and the value.
+        A hit costs one round trip: either the version hash is known locally,
+        or the remembered version is checked in the same MGET as the value.
+        """
+        self._subscribe()
+        version_data = self._versions.get(fname)
 
-            cache_key = hashlib.md5()
+        if version_data is not None and not self._subscribed:
+            cache_key = base_key + version_data
+            current, rv = self.cache.get_many(self._memvname(fname), cache_key)
+            if current == version_data:
+                return cache_key, rv
+            self._versions.pop(fname, None)
 
-            #: this should have to be after version_data, so that it
-            #: does not break the delete_memoized functionality.
-            if callable(make_name):
-                altfname = make_name(fname)
-            else:
-                altfname = fname
+        cache_key = base_key + self._memoize_version(fname)
+        return cache_key, self.cache.get(cache_key)
 
-            if callable(f):
-                keyargs, keykwargs = self.memoize_kwargs_to_args(f,
-                                                                 *args,
-                                                                 **kwargs)
-            else:
-                keyargs, keykwargs = args, kwargs
+    def memoize_make_base_key(self, make_name=None):
+        """
+        Function used to create the version independent part of the cache_key,
+        returns the function namespace and the key.
+        """
+        builders = {}
 
+        def make_base_key(f, *args, **kwargs):
             try:
-                updated = "{0}{1}{2}".format(altfname, keyargs, keykwargs)
-            except AttributeError:
-                updated = "%s%s%s" % (altfname, keyargs, keykwargs)
+                build = builders[f]
+            except KeyError:
+                build = builders[f] = self._compile_key_builder(f, make_name)
+            return build(args, kwargs)
+        return make_base_key
 
-            cache_key.update(updated)
-            cache_key = cache_key.digest().encode('base64')[:16]
-            cache_key += version_data
+    def _compile_key_builder(self, f, make_name=None):
+        """
+        Resolves the argspec and the namespace of `f` once, the returned
+        function builds the same keys as `memoize_kwargs_to_args` and
+        `function_namespace` would on every call.
+        """
+        key_args = compile_key_args(f)
+        m_args = inspect.getargspec(f)[0]
+        first_arg = m_args[0] if m_args else None
+        prefix = '%s.' % f.__module__
+        suffix = '.%s' % f.__name__
+        static_fname = function_namespace(f)
+
+        def altname(fname):
+            return make_name(fname) if callable(make_name) else fname
+        static_altfname = altname(static_fname)
+
+        def build(args, kwargs):
+            if args and first_arg == 'self':
+                fname = prefix + args[0].__class__.__name__ + suffix
+                altfname = altname(fname)
+            elif args and first_arg == 'cls':
+                fname = prefix + args[0].__name__ + suffix
+                altfname = altname(fname)
+            else:
+                fname = static_fname
+                altfname = static_altfname
 
-            return cache_key
-        return make_cache_key
+            #same format as "{0}{1}{2}".format(altfname, keyargs, {})
+            updated = '%s%s{}' % (altfname, key_args(args, kwargs))
+            return fname, binascii.b2a_base64(hashlib.md5(updated).digest())[:16]
+        return build
 
     def memoize_kwargs_to_args(self, f, *args, **kwargs):
 
@@ -232,7 +552,32 @@ class Cache(object):
 
         return tuple(new_args), {}
 
-    def memoize(self, timeout=None, make_name=None, unless=None):
+    def memoize(self, timeout=None, make_name=None, unless=None,
+                local=None, local_threshold=None, local_timeout=None,
+                single_flight=None, soft_timeout=None):
+        """
+        Memoize the return value of a function in the cache backend.
+
+        :param single_flight: on a miss only the caller holding a short Redis
+                              lock recomputes the value, the others wait for
+                              it up to ``CACHE_LOCK_WAIT`` seconds and then
+                              compute it themselves, defaults to
+                              ``CACHE_SINGLE_FLIGHT``.
+        :param soft_timeout: seconds a value is fresh, after that it is still
+                             served (until `timeout`) while one background
+                             refresh runs. Should be smaller than `timeout`.
+
+        :param local: keep hot values in a bounded in-process tier in front of
+                      the backend, defaults to ``CACHE_LOCAL_ENABLED``.
+        :param local_threshold: max number of locally cached values for this
+                                function, defaults to ``CACHE_LOCAL_THRESHOLD``.
+        :param local_timeout: seconds a local value is trusted, defaults to
+                              ``CACHE_LOCAL_TIMEOUT``.
+        """
+        if local is None:
+            local = self.config['CACHE_LOCAL_ENABLED']
+        if single_flight is None:
+            single_flight = self.config['CACHE_SINGLE_FLIGHT']
 
         def memoize(f):
             @functools.wraps(f)
@@ -242,22 +587,132 @@ class Cache(object):
                     return f(*args, **kwargs)
 
                 try:
-                    cache_key = decorated_function.make_cache_key(f, *args, **kwargs)
-                    rv = self.cache.get(cache_key)
+                    fname, base_key = decorated_function.make_base_key(f, *args, **kwargs)
                 except Exception:
                     return f(*args, **kwargs)
 
-                if rv is None:
-                    rv = f(*args, **kwargs)
-                    try:
-                        self.cache.set(cache_key, rv, timeout=decorated_function.cache_timeout)
-                    except Exception:
-                        return f(*args, **kwargs)
+                local_cache = None
+                generation = self._version_generation
+                if local:
+                    local_cache = self._local_cache(fname, local_threshold, local_timeout)
+                    rv = local_cache.get(base_key)
+                    if rv is not None:
+                        return rv
+
+                try:
+                    cache_key, rv = self._memoize_get(fname, base_key)
+                except Exception:
+                    return f(*args, **kwargs)
+
+                rv = self._load(cache_key, rv, f, args, kwargs, decorated_function.cache_timeout,
+                                single_flight, soft_timeout)
+
+                if local_cache is not None and generation == self._version_generation:
+                    self._local_set(local_cache, base_key, rv, local_timeout, decorated_function.cache_timeout)
                 return rv
 
+            decorated_function.uncached = f
+            decorated_function.cache_timeout = timeout
+            decorated_function.soft_timeout = soft_timeout
+            decorated_function.local_options = (local_threshold, local_timeout) if local else None
+            decorated_function.make_cache_key = self.memoize_make_cache_key(make_name)
+            decorated_function.make_base_key = self.memoize_make_base_key(make_name)
+            decorated_function.delete_memoized = lambda: self.delete_memoized(f)
+
+            return decorated_function
+        return memoize
+
+    def _local_set(self, local_cache, key, rv, local_timeout=None, timeout=None):
+        local_cache.set(key, rv, timeout=min(
+            local_timeout or self.config['CACHE_LOCAL_TIMEOUT'],
+            timeout or self.cache.default_timeout))
+
+    def get_many_memoized(self, f, args_list):
+        """
+        Batched lookup of a memoized function, `args_list` holds the positional
+        args of each call. Local hits are served in-process, everything else
+        is read with one MGET. Returns the values in order, None for misses.
+        """
+        values = [None] * len(args_list)
+        pending, keys, local_keys = [], [], []
+        generation = self._version_generation
+
+        for i, args in enumerate(args_list):
+            fname, base_key = f.make_base_key(f.uncached, *args)
+            local_cache = None
+            if f.local_options is not None:
+                local_cache = self._local_cache(fname, *f.local_options)
+                values[i] = local_cache.get(base_key)
+                if values[i] is not None:
+                    continue
+            pending.append(i)
+            keys.append(base_key + self._memoize_version(fname))
+            local_keys.append((local_cache, base_key))
+
+        if keys:
+            for i, rv, (local_cache, base_key) in zip(pending, self.cache.get_many(*keys), local_keys):
+                if rv is not None and f.soft_timeout:
+                    rv = self._unwrap_soft(rv)[1]
+                values[i] = rv
+                if rv is not None and local_cache is not None and generation == self._version_generation:
+                    self._local_set(local_cache, base_key, rv, f.local_options[1], f.cache_timeout)
+        return values
+
+    def set_many_memoized(self, f, args_list, values):
+        """Stores the results of many calls of a memoized function at once."""
+        mapping = {}
+        for args, rv in zip(args_list, values):
+            cache_key = f.make_cache_key(f.uncached, *args)
+            if f.soft_timeout:
+                rv = self._wrap_soft(rv, f.soft_timeout)
+            mapping[cache_key] = rv
+        if mapping:
+            self.cache.set_many(mapping, timeout=f.cache_timeout)
+
+    def memoize_async(self, timeout=None, make_name=None, unless=None):
+        """
+        Like `memoize`, but the decorated function returns a Future and the
+        cache is read and written without blocking the IOLoop. The memoized
+        function may be a coroutine or a plain function, keys are shared with
+        `memoize` so `delete_memoized` works for both.
+        """
+        def memoize(f):
+            @gen.coroutine
+            def call(*args, **kwargs):
+                rv = f(*args, **kwargs)
+                if isinstance(rv, Future):
+                    rv = yield rv
+                raise gen.Return(rv)
+
+            @functools.wraps(f)
+            @gen.coroutine
+            def decorated_function(*args, **kwargs):
+                #: bypass cache
+                if callable(unless) and unless() is True:
+                    rv = yield call(*args, **kwargs)
+                    raise gen.Return(rv)
+
+                try:
+                    fname, base_key = decorated_function.make_base_key(f, *args, **kwargs)
+                    version_data = yield self._memoize_version_async(fname)
+                    cache_key = base_key + version_data
+                    rv = yield self.cache.get_async(cache_key)
+                except Exception:
+                    cache_key, rv = None, None
+
+                if rv is None:
+                    rv = yield call(*args, **kwargs)
+                    if cache_key is not None:
+                        try:
+                            yield self.cache.set_async(cache_key, rv, timeout=decorated_function.cache_timeout)
+                        except Exception:
+                            logging.warning('Can not store %s in the cache.', cache_key)
+                raise gen.Return(rv)
+
             decorated_function.uncached = f
             decorated_function.cache_timeout = timeout
             decorated_function.make_cache_key = self.memoize_make_cache_key(make_name)
+            decorated_function.make_base_key = self.memoize_make_base_key(make_name)
             decorated_function.delete_memoized = lambda: self.delete_memoized(f)
 
             return decorated_function
@@ -275,10 +730,12 @@ class Cache(object):
             if not args and not kwargs:
                 version_key = self._memvname(_fname)
                 version_data = self.memoize_make_version_hash()
-                self.cache.set(version_key, version_data)
+                self.cache.set(version_key, version_data, timeout=VERSION_TIMEOUT)
+                self._publish_invalidation(_fname)
             else:
                 cache_key = f.make_cache_key(f.uncached, *args, **kwargs)
                 self.cache.delete(cache_key)
+                self._publish_invalidation(*f.make_base_key(f.uncached, *args, **kwargs))
         except Exception:
             pass
 
@@ -293,5 +750,6 @@ class Cache(object):
         try:
             version_key = self._memvname(_fname)
             self.cache.delete(version_key)
+            self._publish_invalidation(_fname)
         except Exception:
             pass
\ No newline at end of file
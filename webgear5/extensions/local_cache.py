@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import time
+import threading
+from collections import OrderedDict
+
+
+class LocalCache(object):
+    """
+    Bounded in-process LRU cache, every entry also has an expiry time.
+    """
+
+    def __init__(self, threshold=500, default_timeout=30):
+        self.threshold = threshold
+        self.default_timeout = default_timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.time():
+                return None
+            #re-insert to mark the key as most recently used
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + timeout, value)
+            while len(self._data) > self.threshold:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
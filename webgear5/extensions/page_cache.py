@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import logging
+from uuid import uuid4
+from cStringIO import StringIO
+
+
+class PageCache(object):
+    """
+    Whole responses of anonymous pages in the cache backend. An entry keeps
+    the body, its gzipped copy, the headers and the ETag. Every entry also
+    records the generation it was built in, `invalidate` starts a new
+    generation so all the pages are dropped at once, a lookup reads the
+    generation and the entry with one MGET.
+    """
+
+    def __init__(self, cache, key_prefix='page'):
+        self._cache = cache
+        self.key_prefix = key_prefix
+        self.version_key = '%s:version' % key_prefix
+
+    def make_key(self, method, uri, vary=()):
+        vary = '\n'.join('%s=%s' % item for item in vary)
+        return '%s:%s' % (self.key_prefix, hashlib.md5('%s %s\n%s' % (method, uri, vary)).hexdigest())
+
+    def get(self, key):
+        """
+        Returns (entry or None, generation), a page rendered after a miss is
+        stored with that generation so an invalidation meanwhile drops it.
+        """
+        try:
+            version, entry = self._cache.get_many(self.version_key, key)
+        except Exception:
+            logging.warning('Can not read page cache.')
+            return None, None
+        if entry and entry.get('version') == version:
+            return entry, version
+        return None, version
+
+    def set(self, key, version, body, headers, timeout):
+        try:
+            entry = dict(version=version, body=body, headers=headers,
+                         gzip=self.compress(body),
+                         etag='"%s"' % hashlib.sha1(body).hexdigest())
+            self._cache.set(key, entry, timeout=timeout)
+        except Exception:
+            logging.warning('Can not write page cache.')
+
+    def invalidate(self):
+        try:
+            self._cache.set(self.version_key, uuid4().get_hex(), timeout=30 * 86400)
+        except Exception:
+            logging.warning('Can not invalidate page cache.')
+
+    @staticmethod
+    def compress(body):
+        data = StringIO()
+        with gzip.GzipFile(mode='wb', fileobj=data, mtime=0) as f:
+            f.write(body)
+        return data.getvalue()
@@ -1,7 +1,111 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
+import tornadoredis
+from tornado import gen
 from werkzeug.contrib.cache import RedisCache
 from redis import from_url as redis_from_url
+from serializers import get_serializer
+
+
+class AsyncRedisCache(RedisCache):
+    """
+    RedisCache with coroutine versions of get/set/get_many/delete, they run
+    on a tornadoredis pool and do not block the IOLoop. Values are written
+    with a pluggable serializer, see `serializers`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.serializer = get_serializer(kwargs.pop('serializer', None))
+        self._async_pool = kwargs.pop('async_pool', None)
+        self._async_options = dict(
+            host=kwargs.get('host', 'localhost'),
+            port=kwargs.get('port', 6379),
+            password=kwargs.get('password'),
+            selected_db=kwargs.get('db', 0),
+        )
+        RedisCache.__init__(self, *args, **kwargs)
+
+    def dump_object(self, value):
+        #integers stay plain so that inc/dec keep working
+        if type(value) in (int, long):
+            return str(value)
+        return '!' + self.serializer.dumps(value)
+
+    def load_object(self, value):
+        if value is None:
+            return None
+        if value.startswith('!'):
+            try:
+                return self.serializer.loads(value[1:])
+            except Exception:
+                return None
+        try:
+            return int(value)
+        except ValueError:
+            return value
+
+    def set(self, key, value, timeout=None):
+        #timeout 0 stores the key without expiry
+        if timeout == 0:
+            return self._client.set(self.key_prefix + key, self.dump_object(value))
+        return RedisCache.set(self, key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        if timeout == 0:
+            return self._client.setnx(self.key_prefix + key, self.dump_object(value))
+        return RedisCache.add(self, key, value, timeout)
+
+    def _async_client(self):
+        if self._async_pool is None:
+            return tornadoredis.Client(**self._async_options)
+        return tornadoredis.Client(connection_pool=self._async_pool,
+                                   selected_db=self._async_options['selected_db'],
+                                   password=self._async_options['password'])
+
+    @gen.coroutine
+    def _execute_async(self, command, *args):
+        client = self._async_client()
+        try:
+            result = yield gen.Task(getattr(client, command), *args)
+        finally:
+            yield gen.Task(client.disconnect)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def get_async(self, key):
+        value = yield self._execute_async('get', self.key_prefix + key)
+        raise gen.Return(self.load_object(value))
+
+    @gen.coroutine
+    def get_many_async(self, *keys):
+        if self.key_prefix:
+            keys = [self.key_prefix + key for key in keys]
+        values = yield self._execute_async('mget', list(keys))
+        raise gen.Return([self.load_object(value) for value in values])
+
+    @gen.coroutine
+    def set_async(self, key, value, timeout=None):
+        if timeout == 0:
+            yield self._execute_async('set', self.key_prefix + key, self.dump_object(value))
+            return
+        if timeout is None:
+            timeout = self.default_timeout
+        yield self._execute_async('setex', self.key_prefix + key, timeout, self.dump_object(value))
+
+    @gen.coroutine
+    def add_async(self, key, value, timeout=None):
+        added = yield self._execute_async('setnx', self.key_prefix + key, self.dump_object(value))
+        if added and timeout != 0:
+            yield self._execute_async('expire', self.key_prefix + key, timeout or self.default_timeout)
+        raise gen.Return(added)
+
+    @gen.coroutine
+    def delete_async(self, *keys):
+        if not keys:
+            return
+        if self.key_prefix:
+            keys = [self.key_prefix + key for key in keys]
+        yield self._execute_async('delete', *keys)
 
 
 def redis(config, args, kwargs):
@@ -28,4 +132,12 @@ def redis(config, args, kwargs):
             db=kwargs.pop('db', None),
         )
 
-    return RedisCache(*args, **kwargs)
\ No newline at end of file
+    serializer = config.get('CACHE_SERIALIZER')
+    if serializer:
+        kwargs['serializer'] = serializer
+
+    async_pool = config.get('CACHE_ASYNC_POOL')
+    if async_pool is not None:
+        kwargs['async_pool'] = async_pool
+
+    return AsyncRedisCache(*args, **kwargs)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import cPickle as pickle
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+
+_EPOCH = datetime(1970, 1, 1)
+_DATETIME = 1
+_OBJECTID = 2
+#: ext codes from 16 up are used by `register_codec`
+_classes = {}
+_codes = {}
+
+
+def register_codec(code, cls):
+    """
+    Registers a model class for the msgpack serializer. The class stores
+    itself as the compact state returned by `__getstate__` and is rebuilt
+    with `__setstate__`, pickle uses the same two hooks.
+    """
+    if code < 16:
+        raise ValueError('codec codes below 16 are reserved')
+    if _classes.get(code, cls) is not cls:
+        raise ValueError('codec code %d is already used by %r' % (code, _classes[code]))
+    _classes[code] = cls
+    _codes[cls] = code
+
+
+class PickleSerializer(object):
+    """Default serializer, pickles with the highest protocol."""
+
+    def dumps(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class MsgpackSerializer(object):
+    """
+    msgpack serializer, handles datetime, ObjectId and the model classes
+    registered with `register_codec`. Needs the msgpack package.
+    """
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def _default(self, obj):
+        if isinstance(obj, datetime):
+            delta = obj.replace(tzinfo=None) - _EPOCH
+            micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+            return self.msgpack.ExtType(_DATETIME, self.msgpack.packb(micros))
+        if isinstance(obj, ObjectId):
+            return self.msgpack.ExtType(_OBJECTID, obj.binary)
+        code = _codes.get(obj.__class__)
+        if code is not None:
+            return self.msgpack.ExtType(code, self.dumps(obj.__getstate__()))
+        raise TypeError('%r can not be serialized with msgpack' % obj)
+
+    def _ext_hook(self, code, data):
+        if code == _DATETIME:
+            return _EPOCH + timedelta(microseconds=self.msgpack.unpackb(data))
+        if code == _OBJECTID:
+            return ObjectId(data)
+        cls = _classes.get(code)
+        if cls is None:
+            return self.msgpack.ExtType(code, data)
+        obj = cls.__new__(cls)
+        obj.__setstate__(self.loads(data))
+        return obj
+
+    def dumps(self, value):
+        return self.msgpack.packb(value, default=self._default, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, ext_hook=self._ext_hook, raw=False)
+
+
+serializers = dict(
+    pickle=PickleSerializer,
+    msgpack=MsgpackSerializer,
+)
+
+
+def get_serializer(serializer=None):
+    """Returns a serializer instance for a name, a class or an instance."""
+    if serializer is None:
+        serializer = 'pickle'
+    if isinstance(serializer, basestring):
+        try:
+            serializer = serializers[serializer]
+        except KeyError:
+            raise ImportError('%s is not a valid serializer' % serializer)
+    if isinstance(serializer, type):
+        serializer = serializer()
+    return serializer
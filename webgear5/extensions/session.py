@@ -3,10 +3,19 @@
 import cPickle as pickle
 import time
 import logging
+import tornadoredis
 from uuid import uuid4
+from tornado import gen
+from tornado.escape import json_encode, json_decode
 
 
 class Session(object):
+    """
+    Small session kept in a signed cookie, for visitors without a Redis
+    session. Values are stored as JSON, `save` has to run before the
+    headers are sent.
+    """
+
     def __init__(self, get_secure_cookie, set_secure_cookie, name='_session', expires_days=None):
         self.set_session = set_secure_cookie
         self.get_session = get_secure_cookie
@@ -16,8 +25,14 @@ class Session(object):
         self.get_data()
 
     def get_data(self):
+        #the cookie comes from the client, it is never unpickled
         value = self.get_session(self.name)
-        self._data = pickle.loads(value) if value else {}
+        try:
+            self._data = json_decode(value) if value else {}
+        except ValueError:
+            self._data = {}
+        if not isinstance(self._data, dict):
+            self._data = {}
 
     def set_expires(self, days):
         self._expiry = days
@@ -44,106 +59,338 @@ class Session(object):
         for key in self._data:
             yield key
 
-    def __del__(self):
-        self.save()
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    @property
+    def dirty(self):
+        return self._dirty
 
     def save(self):
         if self._dirty:
-            self.set_session(self.name, pickle.dumps(self._data), expires_days=self._expiry)
+            self.set_session(self.name, json_encode(self._data), expires_days=self._expiry)
             self._dirty = False
 
 
 class RedisSessionStore(object):
-    def __init__(self, redis_connection, **options):
+    """
+    Every session key is a pickled field 'k:<key>' of the session hash.
+    Sessions written by older versions keep the whole dict pickled in the
+    `LEGACY` field, they are converted on their next save.
+    """
+
+    LEGACY = 'data'
+
+    def __init__(self, redis_connection, async_pool=None, **options):
         self.options = {
             'key_prefix': 'session',
             'expire': 7200,
+            'refresh': 600,
+            'db': 0,
         }
         self.options.update(options)
         self.redis = redis_connection
+        self.async_pool = async_pool
 
     def prefixed(self, sid):
         return '%s:%s' % (self.options['key_prefix'], sid)
 
+    @staticmethod
+    def field(key):
+        return 'k:%s' % key
+
     def generate_sid(self):
         return uuid4().get_hex()
 
+    def expiry(self, expiry=None):
+        return expiry or self.options['expire']
+
+    def needs_refresh(self, ttl, expiry=None):
+        """A sliding expiry is renewed once `refresh` seconds of it were used"""
+        expiry = self.expiry(expiry)
+        return bool(expiry) and ttl is not None and 0 <= ttl <= expiry - self.options['refresh']
+
     def get_session(self, sid, name):
         data = self.redis.hget(self.prefixed(sid), name)
         session = pickle.loads(data) if data else dict()
         return session
 
     def set_session(self, sid, session_data, name, expiry=None):
-        self.redis.hset(self.prefixed(sid), name, pickle.dumps(session_data))
-        expiry = expiry or self.options['expire']
+        pipe = self.redis.pipeline()
+        pipe.hset(self.prefixed(sid), name, pickle.dumps(session_data))
+        expiry = self.expiry(expiry)
+        if expiry:
+            pipe.expire(self.prefixed(sid), expiry)
+        pipe.execute()
+
+    def _fields_command(self, pipe, sid, keys):
+        if keys is None:
+            pipe.hgetall(self.prefixed(sid))
+        else:
+            pipe.hmget(self.prefixed(sid), [self.field(key) for key in keys] + [self.LEGACY])
+        pipe.ttl(self.prefixed(sid))
+
+    def _fields_result(self, keys, raw, ttl):
+        if keys is None:
+            legacy = raw.pop(self.LEGACY, None)
+            values = dict((field[2:], pickle.loads(value)) for field, value in raw.iteritems()
+                          if field.startswith('k:'))
+        else:
+            if isinstance(raw, dict):
+                #tornadoredis answers HMGET with a {field: value} dict
+                raw = [raw.get(field) for field in [self.field(key) for key in keys] + [self.LEGACY]]
+            legacy = raw.pop()
+            values = dict((key, pickle.loads(value)) for key, value in zip(keys, raw) if value is not None)
+        return values, (pickle.loads(legacy) if legacy else None), ttl
+
+    def load_fields(self, sid, keys=None):
+        """
+        Returns ({key: value}, legacy dict or None, ttl) of the given keys,
+        or of all keys if `keys` is None, with one round trip.
+        """
+        pipe = self.redis.pipeline(transaction=False)
+        self._fields_command(pipe, sid, keys)
+        raw, ttl = pipe.execute()
+        return self._fields_result(keys, raw, ttl)
+
+    def _save_commands(self, pipe, sid, changed, deleted, expiry, legacy):
+        if changed:
+            pipe.hmset(self.prefixed(sid), dict((self.field(key), pickle.dumps(value))
+                                                for key, value in changed.iteritems()))
+        deleted = [self.field(key) for key in deleted] + ([self.LEGACY] if legacy else [])
+        if deleted:
+            pipe.hdel(self.prefixed(sid), *deleted)
+        expiry = self.expiry(expiry)
+        if expiry:
+            pipe.expire(self.prefixed(sid), expiry)
+
+    def save_fields(self, sid, changed, deleted=(), expiry=None, legacy=False):
+        """HSET of the changed keys, HDEL of the deleted ones and EXPIRE in one MULTI"""
+        pipe = self.redis.pipeline()
+        self._save_commands(pipe, sid, changed, deleted, expiry, legacy)
+        pipe.execute()
+
+    def touch(self, sid, expiry=None):
+        expiry = self.expiry(expiry)
         if expiry:
             self.redis.expire(self.prefixed(sid), expiry)
 
     def delete_session(self, sid):
         self.redis.delete(self.prefixed(sid))
 
+    def _async_client(self):
+        return tornadoredis.Client(connection_pool=self.async_pool, selected_db=self.options['db'])
+
+    @gen.coroutine
+    def get_session_async(self, sid, name):
+        client = self._async_client()
+        try:
+            data = yield gen.Task(client.hget, self.prefixed(sid), name)
+        finally:
+            yield gen.Task(client.disconnect)
+        session = pickle.loads(data) if data else dict()
+        raise gen.Return(session)
+
+    @gen.coroutine
+    def load_fields_async(self, sid, keys=None):
+        client = self._async_client()
+        try:
+            pipe = client.pipeline()
+            self._fields_command(pipe, sid, keys)
+            raw, ttl = yield gen.Task(pipe.execute)
+        finally:
+            yield gen.Task(client.disconnect)
+        raise gen.Return(self._fields_result(keys, raw, ttl))
+
+    @gen.coroutine
+    def save_fields_async(self, sid, changed, deleted=(), expiry=None, legacy=False):
+        client = self._async_client()
+        try:
+            pipe = client.pipeline(transactional=True)
+            self._save_commands(pipe, sid, changed, deleted, expiry, legacy)
+            yield gen.Task(pipe.execute)
+        finally:
+            yield gen.Task(client.disconnect)
+
+    @gen.coroutine
+    def touch_async(self, sid, expiry=None):
+        expiry = self.expiry(expiry)
+        if expiry:
+            client = self._async_client()
+            try:
+                yield gen.Task(client.expire, self.prefixed(sid), expiry)
+            finally:
+                yield gen.Task(client.disconnect)
+
 
 class RedisSession(object):
-    def __init__(self, session_store, session_id=None, expires_days=None):
+    """
+    Session keys are read from Redis on first access, one HMGET per batch
+    of keys, and only the changed and deleted keys are written by an
+    explicit `save`, which BaseHandler calls from on_finish. A new session
+    gets its id, and calls `on_create(id)`, when its first key is set.
+    """
+
+    def __init__(self, session_store, session_id=None, expires_days=None, load=False, on_create=None):
         self._store = session_store
-        self._sid = session_id if session_id else self._store.generate_sid()
-        self._dirty = False
+        self._sid = session_id
+        self._on_create = on_create
+        self._data = {}
+        self._fetched = set()
+        self._changed = set()
+        self._deleted = set()
+        self._legacy = False
+        #a new session has nothing stored yet
+        self._complete = not session_id
+        self._ttl = None
         self.set_expires(expires_days)
+        if load:
+            self._fetch(None)
+
+    def _missing(self, keys):
+        """Keys to read from Redis, None for all of them"""
+        if self._complete:
+            return []
+        if keys is None:
+            self._complete = True
+            return None
+        keys = [key for key in set(keys) if key not in self._fetched]
+        self._fetched.update(keys)
+        return keys
+
+    def _merge(self, values, legacy, ttl):
+        self._ttl = ttl
+        if legacy and not self._legacy:
+            #an old single field session, rewritten as fields on save
+            self._legacy = True
+            for key, value in legacy.iteritems():
+                values.setdefault(key, value)
+                self._changed.add(key)
+            self._complete = True
+        for key, value in values.iteritems():
+            if key not in self._data and key not in self._deleted:
+                self._data[key] = value
+        self._fetched.update(values)
+
+    def _fetch(self, keys):
+        keys = self._missing(keys)
+        if keys == []:
+            return
         try:
-            self._data = self._store.get_session(self._sid, 'data')
+            self._merge(*self._store.load_fields(self._sid, keys))
         except:
             logging.error('Can not connect Redis server.')
-            self._data = {}
+
+    def preload(self, *keys):
+        """Reads several keys with one HMGET"""
+        self._fetch(keys)
+
+    @gen.coroutine
+    def load_async(self, *keys):
+        """Reads the given keys, or all of them, without blocking the IOLoop"""
+        keys = self._missing(keys or None)
+        if keys == []:
+            return
+        try:
+            result = yield self._store.load_fields_async(self._sid, keys)
+            self._merge(*result)
+        except Exception:
+            logging.error('Can not connect Redis server.')
+
+    @property
+    def dirty(self):
+        return bool(self._changed or self._deleted or self._legacy)
+
+    def _pop_changes(self):
+        changed = dict((key, self._data[key]) for key in self._changed if key in self._data)
+        deleted, legacy = list(self._deleted), self._legacy
+        self._changed, self._deleted, self._legacy = set(), set(), False
+        return changed, deleted, legacy
+
+    @gen.coroutine
+    def save_async(self):
+        if self.dirty:
+            changed, deleted, legacy = self._pop_changes()
+            yield self._store.save_fields_async(self._sid, changed, deleted, self._expiry, legacy)
+        elif self._store.needs_refresh(self._ttl, self._expiry):
+            self._ttl = None
+            yield self._store.touch_async(self._sid, self._expiry)
 
     def clear(self):
-        self._store.delete_session(self._sid)
+        if self._sid:
+            self._store.delete_session(self._sid)
+        self._data = {}
+        self._changed, self._deleted, self._legacy = set(), set(), False
+        self._complete = True
+        self._ttl = None
+
+    def _create(self):
+        if self._sid is None:
+            self._sid = self._store.generate_sid()
+            if self._on_create:
+                self._on_create(self._sid)
+        return self._sid
 
     @property
     def id(self):
-        return self._sid
+        return self._create()
 
     def access(self, remote_ip):
         access_info = {'remote_ip': remote_ip, 'time': '%.6f' % time.time()}
-        self._store.set_session(
-            self._sid,
-            'last_access',
-            pickle.dumps(access_info))
+        self._store.set_session(self.id, access_info, 'last_access', self._expiry)
 
     def last_access(self):
-        access_info = self._store.get_session(self._sid, 'last_access')
-        return pickle.loads(access_info)
+        return self._store.get_session(self._sid, 'last_access') if self._sid else {}
 
     def set_expires(self, days):
         self._expiry = days * 86400 if days else None
 
+    def get(self, key, default=None):
+        self._fetch([key])
+        return self._data.get(key, default)
+
     def __getitem__(self, key):
+        self._fetch([key])
         return self._data[key]
 
     def __setitem__(self, key, value):
+        self._create()
         self._data[key] = value
-        self._dirty = True
+        self._fetched.add(key)
+        self._changed.add(key)
+        self._deleted.discard(key)
 
     def __delitem__(self, key):
+        self._fetch([key])
         del self._data[key]
-        self._dirty = True
+        self._changed.discard(key)
+        self._deleted.add(key)
 
     def __len__(self):
+        self._fetch(None)
         return len(self._data)
 
     def __contains__(self, key):
+        self._fetch([key])
         return key in self._data
 
     def __iter__(self):
-        for key in self._data:
+        self._fetch(None)
+        for key in self._data.keys():
             yield key
 
     def __repr__(self):
+        self._fetch(None)
         return self._data.__repr__()
 
-    def __del__(self):
-        self.save()
-
     def save(self):
-        if self._dirty:
-            self._store.set_session(self._sid, self._data, 'data', self._expiry)
-            self._dirty = False
\ No newline at end of file
+        """Writes the changed keys, otherwise renews a used up sliding expiry"""
+        try:
+            if self.dirty:
+                changed, deleted, legacy = self._pop_changes()
+                self._store.save_fields(self._sid, changed, deleted, self._expiry, legacy)
+            elif self._store.needs_refresh(self._ttl, self._expiry):
+                self._store.touch(self._sid, self._expiry)
+                self._ttl = None
+        except:
+            logging.error('Can not connect Redis server.')
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import logging
+from jinja2 import Environment, FileSystemLoader, ModuleLoader, ChoiceLoader, FileSystemBytecodeCache
+
+
+def create_environment(template_path, debug=True, bytecode_cache_path=None, modules_path=None, **options):
+    """
+    Jinja environment of the application. In debug mode templates are
+    reloaded when they change. Otherwise they are never checked again,
+    compiled bytecode is kept in `bytecode_cache_path` across restarts,
+    and templates precompiled by `compile_modules` into `modules_path`
+    are used before the sources.
+    """
+    loaders = [FileSystemLoader(template_path)]
+    if not debug and modules_path and os.path.isdir(modules_path):
+        loaders.insert(0, ModuleLoader(modules_path))
+
+    bytecode_cache = None
+    if not debug and bytecode_cache_path:
+        if not os.path.isdir(bytecode_cache_path):
+            os.makedirs(bytecode_cache_path)
+        bytecode_cache = FileSystemBytecodeCache(bytecode_cache_path)
+
+    return Environment(
+        loader=loaders[0] if len(loaders) == 1 else ChoiceLoader(loaders),
+        auto_reload=debug,
+        bytecode_cache=bytecode_cache,
+        #without reloading a plain dict holds every template, no LRU bookkeeping
+        cache_size=400 if debug else -1,
+        **options)
+
+
+def _source_loader(env):
+    for loader in getattr(env.loader, 'loaders', [env.loader]):
+        if isinstance(loader, FileSystemLoader):
+            return loader
+
+
+def preload(env):
+    """Compiles every template into the environment cache, returns how many were loaded"""
+    total = 0
+    for name in _source_loader(env).list_templates():
+        try:
+            env.get_template(name)
+            total += 1
+        except Exception:
+            logging.exception('Can not load template %s.', name)
+    return total
+
+
+def compile_modules(env, target):
+    """
+    Precompiles the template directory to python modules for ModuleLoader,
+    run it again after the templates changed.
+    """
+    env.overlay(loader=_source_loader(env)).compile_templates(target, zip=None, py_compile=True)
+
+
+if __name__ == '__main__':
+    from webgear5.settings import settings, jinja_environment
+    compile_modules(jinja_environment, settings['template_modules_path'])
+    print '... templates compiled to %s ...' % settings['template_modules_path']
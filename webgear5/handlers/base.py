@@ -2,27 +2,130 @@
 #-*- coding: utf-8 -*-
 import tornado.web
 import tornado.locale
-from webgear5.extensions.session import RedisSession
+from tornado import gen
+from webgear5.extensions.session import RedisSession, Session
+from webgear5.settings import page_cache
+
+#headers that are not replayed from a cached page
+UNCACHED_HEADERS = ('Date', 'Server', 'Content-Length', 'Content-Encoding', 'Transfer-Encoding',
+                    'Etag', 'Vary', 'Set-Cookie')
 
 
 class BaseHandler(tornado.web.RequestHandler):
 
+    #seconds anonymous GET responses are cached, 0 disables the page cache.
+    #Cached pages must not embed per visitor data such as xsrf_form_html
+    page_cache_timeout = 0
+    #request headers and cookies that change the page
+    page_cache_vary = ('X-PJAX', 'X-Requested-With')
+    page_cache_cookies = ('lang',)
+
+    _page_capture = None
+
+    def prepare(self):
+        if self.page_cache_timeout and self.request.method == 'GET' and not self.current_user:
+            self._serve_cached_page()
+
+    def _page_cache_key(self):
+        vary = [(name, self.request.headers.get(name, '')) for name in self.page_cache_vary]
+        vary.extend(('cookie:' + name, self.get_cookie(name, '')) for name in self.page_cache_cookies)
+        return page_cache.make_key(self.request.method, self.request.uri, vary)
+
+    def _serve_cached_page(self):
+        key = self._page_cache_key()
+        entry, version = page_cache.get(key)
+        if entry is None:
+            #render the page and keep what is written for on_finish
+            self._page_capture = (key, version, [])
+            return
+
+        #the stored headers replace the defaults, repeated ones are added
+        replayed = set()
+        for name, value in entry['headers']:
+            if name in replayed:
+                self.add_header(name, value)
+            else:
+                self.set_header(name, value)
+                replayed.add(name)
+        self.set_header('Etag', entry['etag'])
+        if_none_match = self.request.headers.get('If-None-Match', '')
+        if if_none_match.strip() == '*' or entry['etag'] in [tag.strip() for tag in if_none_match.split(',')]:
+            self.set_status(304)
+        elif (self.settings.get('gzip') or self.settings.get('compress_response')) and \
+                'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            #a Content-Encoding header keeps the gzip transform from compressing it again
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(entry['gzip'])
+        else:
+            self.write(entry['body'])
+        self.finish()
+
+    def _store_page(self):
+        key, version, chunks = self._page_capture
+        self._page_capture = None
+        #a response setting cookies belongs to one visitor
+        if self.get_status() != 200 or getattr(self, '_new_cookie', None) or getattr(self, '_new_cookies', None):
+            return
+        headers = [(name, value) for name, value in self._headers.get_all() if name not in UNCACHED_HEADERS]
+        page_cache.set(key, version, ''.join(chunks), headers, self.page_cache_timeout)
+
+    def write(self, chunk):
+        super(BaseHandler, self).write(chunk)
+        if self._page_capture is not None:
+            self._page_capture[2].append(self._write_buffer[-1])
+
     def get_current_user(self):
-        user = self.session['user'] if 'user' in self.session else None
-        return user
+        #visitors without a sid cookie never logged in, Redis is not asked
+        if not hasattr(self, '_session') and not self.get_secure_cookie('sid'):
+            return None
+        return self.session.get('user')
 
     @property
     def session(self):
         if hasattr(self, '_session'):
             return self._session
         else:
-            self.require_setting('session_lifetime', 'session')
-            expires = self.settings['session_lifetime'] or None
-            session_id = self.get_secure_cookie('sid')
-            self._session = RedisSession(self.application.session_store, session_id, expires_days=expires)
-            if not session_id:
-                self.set_secure_cookie('sid', self._session.id, expires_days=expires)
-            return self._session
+            return self._create_session()
+
+    @gen.coroutine
+    def load_session_async(self):
+        """Loads the session without blocking the IOLoop, yield it from prepare()"""
+        yield self.session.load_async()
+        raise gen.Return(self._session)
+
+    @property
+    def cookie_session(self):
+        """Signed cookie session for small anonymous state, it costs no Redis access"""
+        if not hasattr(self, '_cookie_session'):
+            self._cookie_session = Session(self.get_secure_cookie, self.set_secure_cookie,
+                                           expires_days=self.settings.get('session_lifetime') or None)
+        return self._cookie_session
+
+    def flush(self, *args, **kwargs):
+        if not self._headers_written and getattr(self, '_cookie_session', None) is not None:
+            self._cookie_session.save()
+        return super(BaseHandler, self).flush(*args, **kwargs)
+
+    def on_finish(self):
+        if hasattr(self, '_session'):
+            self._session.save()
+        if self._page_capture is not None:
+            self._store_page()
+
+    def _create_session(self):
+        """
+        The Redis session and its sid cookie are only created when a key is
+        set, visitors that never write one cost no Redis access.
+        """
+        self.require_setting('session_lifetime', 'session')
+        expires = self.settings['session_lifetime'] or None
+
+        def set_sid(sid):
+            self.set_secure_cookie('sid', sid, expires_days=expires)
+
+        self._session = RedisSession(self.application.session_store, self.get_secure_cookie('sid'),
+                                     expires_days=expires, on_create=set_sid)
+        return self._session
 
     def get_user_locale(self):
         code = self.get_cookie('lang', self.settings.get('default_locale', 'zh_CN'))
@@ -58,5 +161,25 @@ class BaseHandler(tornado.web.RequestHandler):
         )
 
     def _jinja_render(self, path, filename, **context):
+        """
+        Renders a template. With the `template_stream_buffer` setting the
+        page is written and flushed every time that many characters were
+        generated. An error after the first flush can not become an error
+        page anymore, and headers and cookies set after it are lost.
+        """
         template = self.application.jinja_env.get_template(filename, parent=path)
-        self.write(template.render(**context))
\ No newline at end of file
+        buffer_size = self.settings.get('template_stream_buffer', 0)
+        if not buffer_size:
+            self.write(template.render(**context))
+            return
+
+        chunks, size = [], 0
+        for chunk in template.generate(**context):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size:
+                self.write(u''.join(chunks))
+                self.flush()
+                chunks, size = [], 0
+        if chunks:
+            self.write(u''.join(chunks))
\ No newline at end of file
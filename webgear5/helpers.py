@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 #-*- coding: utf-8 -*-
+import os
+import base64
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import DESCENDING, ASCENDING
+
+_EPOCH = datetime(1970, 1, 1)
 
 
 class cached_property(object):
-    """Property lazy loading"""
+    """Property lazy loading, slotted classes keep the values in a `_cached` slot"""
     def __init__(self, func, name=None, doc=None):
         self.__name__ = name or func.__name__
         self.__module__ = func.__module__
@@ -12,8 +19,117 @@ class cached_property(object):
     def __get__(self, obj, type=None):
         if obj is None:
             return self
-        value = obj.__dict__.get(self.__name__, None)
+        cache = getattr(obj, '__dict__', None)
+        if cache is None:
+            cache = getattr(obj, '_cached', None)
+            if cache is None:
+                cache = obj._cached = {}
+        value = cache.get(self.__name__, None)
         if value is None:
             value = self.func(obj)
-            obj.__dict__[self.__name__] = value
-        return value
\ No newline at end of file
+            cache[self.__name__] = value
+        return value
+
+class LazyConnection(object):
+    """Connection proxy, the real client is created on first use
+    and re-created in a forked child process"""
+    def __init__(self, factory):
+        self._factory = factory
+        self._pid = None
+        self._conn = None
+
+    def _connect(self):
+        pid = os.getpid()
+        if self._conn is None or self._pid != pid:
+            self._conn = self._factory()
+            self._pid = pid
+        return self._conn
+
+    def reset(self):
+        self._conn = None
+        self._pid = None
+
+    def __getattr__(self, name):
+        return getattr(self._connect(), name)
+
+    def __getitem__(self, name):
+        return self._connect()[name]
+
+
+class CompactState(object):
+    """Pickles (and msgpacks) only the attributes named in `_state`"""
+    __slots__ = ()
+    _state = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self._state)
+
+    def __setstate__(self, state):
+        #values cached before a field was added are filled with None
+        state = tuple(state) + (None,) * (len(self._state) - len(state))
+        for name, value in zip(self._state, state):
+            setattr(self, name, value)
+
+
+def set_cached(obj, name, value):
+    """Fills a `cached_property` value from outside, e.g. after a batch load"""
+    cache = getattr(obj, '__dict__', None)
+    if cache is None:
+        cache = getattr(obj, '_cached', None)
+        if cache is None:
+            cache = obj._cached = {}
+    cache[name] = value
+
+
+def encode_cursor(direction, date, key):
+    """Opaque keyset paging cursor, `direction` is 'n' (older) or 'p' (newer)"""
+    delta = date.replace(tzinfo=None) - _EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    kind = 'o' if isinstance(key, ObjectId) else 'i'
+    return base64.urlsafe_b64encode('%s|%d|%s%s' % (direction, micros, kind, key)).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (direction, date, key), None for a malformed cursor"""
+    try:
+        cursor = str(cursor)
+        direction, micros, key = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).split('|')
+        if direction not in ('n', 'p'):
+            return None
+        date = _EPOCH + timedelta(microseconds=int(micros))
+        key = ObjectId(key[1:]) if key[0] == 'o' else int(key[1:])
+    except Exception:
+        return None
+    return direction, date, key
+
+
+def keyset_find(collection, query, date_field, key_field, cursor=None, size=50):
+    """
+    One page of `query` ordered by (date_field, key_field) descending, starting
+    after `cursor` instead of skipping. Returns (docs, next_cursor, prev_cursor).
+    """
+    decoded = decode_cursor(cursor) if cursor else None
+    direction = decoded[0] if decoded else 'n'
+    if decoded:
+        date, key = decoded[1:]
+        op = '$lt' if direction == 'n' else '$gt'
+        query = {'$and': [query, {'$or': [
+            {date_field: {op: date}},
+            {date_field: date, key_field: {op: key}}
+        ]}]}
+
+    order = DESCENDING if direction == 'n' else ASCENDING
+    docs = list(collection.find(query).sort([(date_field, order), (key_field, order)]).limit(size + 1))
+    has_more = len(docs) > size
+    docs = docs[:size]
+    if direction == 'p':
+        docs.reverse()
+    if not docs:
+        return docs, None, None
+
+    has_next = has_more if direction == 'n' else True
+    has_prev = decoded is not None if direction == 'n' else has_more
+    first, last = docs[0], docs[-1]
+    next_cursor = encode_cursor('n', last.get(date_field, datetime.min), last[key_field]) if has_next else None
+    prev_cursor = encode_cursor('p', first.get(date_field, datetime.min), first[key_field]) if has_prev else None
+    return docs, next_cursor, prev_cursor
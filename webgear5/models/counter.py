@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from webgear5.settings import db
+from .ranking import PosterRanking
+
+
+class Counter(object):
+    """
+    Totals kept in the `counters` collection, one {_id: name, n: total}
+    document per counter. They are updated with $inc when topics, replies,
+    prime flags and favorites change, a missing counter is counted once
+    and stored, `rebuild` recomputes all of them from scratch.
+    """
+
+    @staticmethod
+    def topics(node_id=None):
+        return 'topics:node:%s' % node_id if node_id else 'topics'
+
+    @staticmethod
+    def primes(node_id=None):
+        return 'primes:node:%s' % node_id if node_id else 'primes'
+
+    @staticmethod
+    def tag_topics(tag_id):
+        return 'topics:tag:%s' % tag_id
+
+    @staticmethod
+    def user_topics(username):
+        return 'topics:user:%s' % username
+
+    @staticmethod
+    def user_primes(username):
+        return 'primes:user:%s' % username
+
+    @staticmethod
+    def user_replies(username):
+        return 'replies:user:%s' % username
+
+    @staticmethod
+    def get(name, count=None):
+        """Returns a counter, `count` computes and stores a missing one."""
+        counter = db.counters.find_one({'_id': name})
+        if counter is not None:
+            return counter['n']
+        if count is None:
+            return 0
+        total = count()
+        db.counters.update({'_id': name}, {'$setOnInsert': {'n': total}}, upsert=True)
+        return total
+
+    @staticmethod
+    def get_many(names, count=None):
+        """
+        Returns {name: total} with one query. If some counters are missing,
+        `count` returns {name: total} for them and they are stored, otherwise
+        missing counters are 0.
+        """
+        totals = dict((name, 0) for name in names)
+        found = set()
+        for counter in db.counters.find({'_id': {'$in': list(names)}}):
+            totals[counter['_id']] = counter['n']
+            found.add(counter['_id'])
+
+        missing = [name for name in totals if name not in found]
+        if missing and count is not None:
+            counted = count()
+            for name in missing:
+                totals[name] = counted.get(name, 0)
+                db.counters.update({'_id': name}, {'$setOnInsert': {'n': totals[name]}}, upsert=True)
+        return totals
+
+    @staticmethod
+    def incr(names, delta=1):
+        """Adjusts stored counters, a missing one stays missing until it is counted."""
+        names = list(set(names))
+        if names:
+            db.counters.update({'_id': {'$in': names}}, {'$inc': {'n': delta}}, multi=True)
+
+    @staticmethod
+    def topic_names(topic):
+        """Counters a topic document is counted in."""
+        node_id = topic.get('node_id')
+        username = topic.get('username')
+        names = [Counter.topics(), Counter.user_topics(username)]
+        if node_id:
+            names.append(Counter.topics(node_id))
+        names.extend(Counter.tag_topics(tag_id) for tag_id in topic.get('tags', []))
+        if topic.get('is_prime'):
+            names.extend([Counter.primes(), Counter.user_primes(username)])
+            if node_id:
+                names.append(Counter.primes(node_id))
+        return names
+
+    @staticmethod
+    def topic_created(topic):
+        Counter.incr(Counter.topic_names(topic))
+        PosterRanking.add(topic)
+
+    @staticmethod
+    def topic_deleted(topic):
+        Counter.incr(Counter.topic_names(topic), -1)
+        PosterRanking.add(topic, -1)
+
+    @staticmethod
+    def topic_changed(old, new):
+        """Moves a topic between counters after its tags or prime flag changed."""
+        old_names = Counter.topic_names(old)
+        new_names = Counter.topic_names(new)
+        Counter.incr([name for name in old_names if name not in new_names], -1)
+        Counter.incr([name for name in new_names if name not in old_names])
+
+    @staticmethod
+    def reply_created(username):
+        Counter.incr([Counter.user_replies(username)])
+
+    @staticmethod
+    def reply_deleted(username):
+        Counter.incr([Counter.user_replies(username)], -1)
+
+    @staticmethod
+    def rebuild():
+        """Recomputes every counter from the topics and posts collections."""
+        totals = {Counter.topics(): db.topics.count(),
+                  Counter.primes(): db.topics.find({'is_prime': True}).count()}
+
+        def group(collection, key, match, name):
+            pipeline = [{'$group': {'_id': key, 'n': {'$sum': 1}}}]
+            if match:
+                pipeline.insert(0, {'$match': match})
+            if key == '$tags':
+                pipeline.insert(0, {'$unwind': '$tags'})
+            for row in collection.aggregate(pipeline)['result']:
+                if row['_id']:
+                    totals[name(row['_id'])] = row['n']
+
+        group(db.topics, '$node_id', None, Counter.topics)
+        group(db.topics, '$node_id', {'is_prime': True}, Counter.primes)
+        group(db.topics, '$tags', None, Counter.tag_topics)
+        group(db.topics, '$username', None, Counter.user_topics)
+        group(db.topics, '$username', {'is_prime': True}, Counter.user_primes)
+        group(db.posts, '$username', {'index_id': {'$gt': 0}}, Counter.user_replies)
+
+        for name, total in totals.iteritems():
+            db.counters.update({'_id': name}, {'$set': {'n': total}}, upsert=True)
+        db.counters.remove({'_id': {'$nin': totals.keys()}})
+        return len(totals)
+
+
+if __name__ == '__main__':
+    print '... %d counters rebuilt ...' % Counter.rebuild()
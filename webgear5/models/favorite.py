@@ -1,31 +1,66 @@
 from webgear5.settings import db, cache
+from webgear5.helpers import CompactState
+from webgear5.extensions.serializers import register_codec
 
 
-class Favorite:
+class Favorite(CompactState):
+
+    _state = ('id', 'username', 'posts')
+    __slots__ = _state
 
     def __init__(self, favorite=None):
         self.id = favorite.get('_id', '')
         self.username = favorite.get('username', '')
         self.posts = favorite.get('posts', [])
-        self.favorite = favorite
 
     @property
     def total(self):
         return len(self.posts)
 
     def add(self, topic_id):
-        if not topic_id in self.posts:
+        delta = Favorite.toggle(self.username, topic_id)
+        if delta > 0:
             self.posts.append(topic_id)
-            self.__save()
-            return 1
-        else:
+        elif topic_id in self.posts:
             self.posts.remove(topic_id)
-            self.__save()
-            return -1
+        return delta
 
-    def __save(self):
-        self.favorite['posts'] = self.posts
-        db.favorites.save(self.favorite)
+    @staticmethod
+    def toggle(username, topic_id):
+        """
+        Adds or removes a favorite topic with atomic $addToSet/$pull updates,
+        returns 1 when it was added and -1 when it was removed.
+        """
+        added = db.favorites.update({'username': username, 'posts': {'$ne': topic_id}},
+                                    {'$addToSet': {'posts': topic_id}})
+        if added.get('n'):
+            delta = 1
+        else:
+            removed = db.favorites.update({'username': username, 'posts': topic_id},
+                                          {'$pull': {'posts': topic_id}})
+            if removed.get('n'):
+                delta = -1
+            else:
+                #first favorite of this member
+                db.favorites.update({'username': username},
+                                    {'$addToSet': {'posts': topic_id}}, upsert=True)
+                delta = 1
+
+        #the favorites field of the topic is its favorites counter
+        db.topics.update({'topic_id': topic_id}, {'$inc': {'favorites': delta}})
+        cache.delete_memoized(Favorite.get_by_username, username)
+        return delta
+
+    @staticmethod
+    def has(username, topic_id):
+        return db.favorites.find_one({'username': username, 'posts': topic_id}, {'_id': 1}) is not None
+
+    @staticmethod
+    def get_posts(username, page=1, size=50):
+        """One page of favorite topic ids in the order they were added, read with $slice"""
+        favorite = db.favorites.find_one({'username': username},
+                                         {'posts': {'$slice': [(page - 1) * size, size]}})
+        return favorite.get('posts', []) if favorite else []
 
     @staticmethod
     @cache.memoize()
@@ -37,8 +72,16 @@ class Favorite:
 
     @staticmethod
     def delete(topic_id):
-        for fav in db.favorites.find():
-            if topic_id in fav.get('posts', []):
-                fav['posts'].remove(topic_id)
-                db.favorites.save(fav)
-                cache.delete_memoized_verhash(Favorite.get_by_username, fav['username'])
+        usernames = [fav['username'] for fav in db.favorites.find({'posts': topic_id}, {'username': 1})]
+        if usernames:
+            db.favorites.update({'posts': topic_id}, {'$pull': {'posts': topic_id}}, multi=True)
+            for username in usernames:
+                cache.delete_memoized(Favorite.get_by_username, username)
+
+    @staticmethod
+    def ensure_indexes():
+        db.favorites.ensure_index('username', unique=True)
+        db.favorites.ensure_index('posts')
+
+
+register_codec(22, Favorite)
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import time
+from webgear5.settings import rdb
+
+
+class HotTopics(object):
+    """
+    Hot topics leaderboard. Views and replies are added with ZINCRBY to a
+    sorted set per day (and per node and day), the sets expire after the
+    window. The board is the union of the last `WINDOW` days where a day
+    counts `DECAY` times less than the following one, it is rebuilt at most
+    every `REFRESH` seconds.
+    """
+
+    VIEW = 1
+    REPLY = 10
+    WINDOW = 7
+    DECAY = 0.5
+    REFRESH = 60
+
+    @staticmethod
+    def _day(now=None):
+        return int((now or time.time()) // 86400)
+
+    @staticmethod
+    def _key(day, node_id=None):
+        if node_id:
+            return 'hot:topics:%s:%d' % (node_id, day)
+        return 'hot:topics:%d' % day
+
+    @staticmethod
+    def record(topic_id, node_id=None, weight=VIEW, pipe=None):
+        """Scores a view or reply, pass `pipe` to batch it with other commands."""
+        execute = pipe is None
+        if pipe is None:
+            pipe = rdb.pipeline(transaction=False)
+        day = HotTopics._day()
+        for key in set([HotTopics._key(day), HotTopics._key(day, node_id)]):
+            pipe.zincrby(key, topic_id, weight)
+            pipe.expire(key, (HotTopics.WINDOW + 1) * 86400)
+        if execute:
+            pipe.execute()
+
+    @staticmethod
+    def add_reply(topic_id, node_id=None):
+        HotTopics.record(topic_id, node_id, HotTopics.REPLY)
+
+    @staticmethod
+    def top(size=10, node_id=None):
+        """Returns the ids of the `size` hottest topics, best first."""
+        board = 'hot:topics:board:%s' % (node_id or 0)
+        if not rdb.exists(board):
+            today = HotTopics._day()
+            days = range(today - HotTopics.WINDOW + 1, today + 1)
+            keys = dict((HotTopics._key(day, node_id), HotTopics.DECAY ** (today - day)) for day in days)
+            pipe = rdb.pipeline()
+            pipe.zunionstore(board, keys)
+            pipe.expire(board, HotTopics.REFRESH)
+            pipe.execute()
+        return [int(topic_id) for topic_id in rdb.zrevrange(board, 0, size - 1)]
@@ -2,15 +2,22 @@
 #-*- coding: utf-8 -*-
 import re
 from hashlib import md5
-from bson.son import SON
 from urllib import unquote
 from datetime import datetime
-from pymongo import DESCENDING, ASCENDING
-from webgear5.settings import db, settings, cache
-from webgear5.helpers import cached_property
+from pymongo import DESCENDING
+from webgear5.settings import db, rdb, settings, cache
+from webgear5.helpers import cached_property, keyset_find, CompactState
+from webgear5.extensions.serializers import register_codec
+from .counter import Counter
+from .ranking import PosterRanking
+from .member_index import MemberIndex
 
+LOWER_FIELDS = ('username_lower', 'email_lower', 'nickname_lower')
+BACKFILLED = 'members:lower:backfilled'
+BACKFILL_LOCK = 'members:lower:lock'
 
-class Member:
+
+class Member(CompactState):
 
     BANNED = 1 << 0
     MEMBER = 1 << 1
@@ -18,6 +25,10 @@ class Member:
     MODERATOR = 1 << 7
     ADMIN = 1 << 8
 
+    _state = ('username', 'email', 'registered_date', 'last_login', 'login_date',
+              'roles', 'ip_address', 'profile', 'settings', 'token')
+    __slots__ = _state + ('_cached',)
+
     def __init__(self, member=None):
         self.username = member.get('username')
         self.email = member.get('email')
@@ -88,15 +99,18 @@ class Member:
 
     @cached_property
     def total_topics(self):
-        return db.topics.find({'username': self.username}).count()
+        return Counter.get(Counter.user_topics(self.username),
+                           lambda: db.topics.find({'username': self.username}).count())
 
     @cached_property
     def total_replies(self):
-        return db.posts.find({'username': self.username, 'index_id': {'$gt': 0}}).count()
+        return Counter.get(Counter.user_replies(self.username),
+                           lambda: db.posts.find({'username': self.username, 'index_id': {'$gt': 0}}).count())
 
     @cached_property
     def total_primes(self):
-        return db.topics.find({'username': self.username, 'is_prime': True}).count()
+        return Counter.get(Counter.user_primes(self.username),
+                           lambda: db.topics.find({'username': self.username, 'is_prime': True}).count())
 
     @property
     def json(self):
@@ -125,66 +139,114 @@ class Member:
         return [Member(member) for member in members], members.count()
 
     @staticmethod
-    @cache.memoize()
+    def get_members_by_cursor(cursor=None, size=50):
+        """
+        Keyset paged get_members, ordered by registered_date. Returns
+        (members, total, next_cursor, prev_cursor).
+        """
+        members, next_cursor, prev_cursor = keyset_find(db.members, {}, 'registered_date', '_id', cursor, size)
+        if not members:
+            return [], 0, None, None
+        return [Member(member) for member in members], db.members.count(), next_cursor, prev_cursor
+
+    @staticmethod
+    @cache.memoize(local=True)
     def get_by_username(username):
         member = db.members.find_one({'username': username})
         return Member(member) if member else None
 
+    @staticmethod
+    def get_by_usernames(usernames):
+        """
+        Batched get_by_username, returns {username: Member}. Cached members
+        come from one MGET, the misses from a single $in query.
+        """
+        usernames = list(set(username for username in usernames if username))
+        args_list = [(username,) for username in usernames]
+        try:
+            cached = cache.get_many_memoized(Member.get_by_username, args_list)
+        except Exception:
+            cached = [None] * len(usernames)
+
+        members = dict((member.username, member) for member in cached if member is not None)
+        misses = [username for username in usernames if username not in members]
+        if misses:
+            found = [Member(member) for member in db.members.find({'username': {'$in': misses}})]
+            for member in found:
+                members[member.username] = member
+            try:
+                cache.set_many_memoized(Member.get_by_username,
+                                        [(member.username,) for member in found], found)
+            except Exception:
+                pass
+        return members
+
+    @staticmethod
+    def lower(value):
+        return value.lower() if value else value
+
+    @staticmethod
+    def normalize(member):
+        """
+        Sets the lowercase shadow fields of a member document, call it before
+        every write and MemberIndex.add after it. Empty fields are left out so
+        the sparse unique indexes skip them.
+        """
+        values = (member.get('username'), member.get('email'), member.get('profile', {}).get('nickname'))
+        for field, value in zip(LOWER_FIELDS, values):
+            if value:
+                member[field] = value.lower()
+            else:
+                member.pop(field, None)
+        return member
+
     @staticmethod
     def search_by_username(username):
-        username = unquote(username)
-        name = '^%s$' % username.replace('[', '\[').replace(']', '\]')
-        return db.members.find_one({
-            'username': re.compile(name, re.IGNORECASE)
-        })
+        return db.members.find_one({'username_lower': Member.lower(unquote(username))})
 
     @staticmethod
     def search_by_email(email):
-        name = "^%s$" % email
-        return db.members.find_one({
-            'email': re.compile(name, re.IGNORECASE)
-        })
+        return db.members.find_one({'email_lower': Member.lower(email)})
 
     @staticmethod
     def search_by_nickname(nickname):
-        name = '^%s$' % nickname
-        return db.members.find_one({
-            'profile.nickname': re.compile(name, re.IGNORECASE)
-        })
+        return db.members.find_one({'nickname_lower': Member.lower(nickname)})
 
     @staticmethod
-    def admin_search(username, page=1, size=50):
-        username = unquote(username)
-        name = r'%s' % username.replace('[', '\[').replace(']', '\]')
-        members = db.members.find({
-            '$or': [
-                {'username': re.compile(name, re.IGNORECASE)},
-                {'profile.nickname': re.compile(name, re.IGNORECASE)},
-                {'email': re.compile(name, re.IGNORECASE)}
-            ]
-        }).sort('registered_date', DESCENDING)\
-            .skip((page - 1) * size)\
-            .limit(size)
+    def _search(query, fields, page, size):
+        usernames, total, truncated = MemberIndex.search(unquote(query), fields, page, size)
+        if not usernames:
+            return [], 0, truncated
+        members = Member.get_by_usernames(usernames)
+        return [members[username] for username in usernames if username in members], total, truncated
 
-        if members.count(True) == 0:
-            return [], 0
-        return [Member(member) for member in members], members.count()
+    @staticmethod
+    def admin_search(username, page=1, size=50):
+        """
+        Members whose username, nickname or email contain `username`, ranked
+        exact > prefix > substring. Queries the search index can not answer
+        completely are run on Mongo instead, in username order, so every
+        page can be reached and the total is exact.
+        """
+        members, total, truncated = Member._search(username, MemberIndex.FIELDS, page, size)
+        if not truncated:
+            return members, total
+
+        pattern = re.escape(Member.lower(unquote(username)))
+        cursor = db.members.find({'$or': [{field: {'$regex': pattern}} for field in LOWER_FIELDS]}) \
+            .sort('username_lower')
+        total = cursor.count()
+        return [Member(member) for member in cursor.skip((page - 1) * size).limit(size)], total
 
     @staticmethod
     def search(username, page=1, size=20):
-        username = unquote(username)
-        name = r'%s' % username.replace('[', '\[').replace(']', '\]')
-        members = db.members.find({
-            '$or': [
-                {'username': re.compile(name, re.IGNORECASE)}
-            ]
-        }).sort('username', ASCENDING)\
-            .skip((page - 1) * size)\
-            .limit(size)
-
-        if members.count(True) == 0:
-            return [], 0
-        return [Member(member) for member in members], members.count()
+        """
+        Members whose username contains `username`, ranked exact > prefix >
+        substring. Reads at most MemberIndex.LIMIT candidates per kind of
+        match, `truncated` tells that more members may match than `total`.
+        Returns (members, total, truncated).
+        """
+        return Member._search(username, ('username',), page, size)
 
     @staticmethod
     def login(username, password, ip_address):
@@ -194,7 +256,8 @@ class Member:
             member['login_date'] = datetime.now()
             member['ip_address'] = ip_address
             member['last_ip'] = member['ip_address']
-            db.members.save(member)
+            db.members.save(Member.normalize(member))
+            MemberIndex.add(member)
             return member
         return None
 
@@ -220,16 +283,62 @@ class Member:
         ]
 
     @staticmethod
-    def get_top_topics_users(size=10):
-        result = db.topics.aggregate([
-            {'$group': {'_id': '$username',  'count': {'$sum': 1}}},
-            {'$sort': SON([('count', -1), ('_id', -1)])},
-            {'$limit': size}
-        ])
-        return result['result']
+    def ensure_indexes():
+        db.members.ensure_index('username_lower', unique=True, sparse=True)
+        db.members.ensure_index('email_lower', unique=True, sparse=True)
+        db.members.ensure_index('nickname_lower', sparse=True)
 
+    @staticmethod
+    def backfill_lower():
+        """Migration: fills the lowercase shadow fields of the existing members, then indexes them."""
+        total = 0
+        bulk = db.members.initialize_unordered_bulk_op()
+        fields = {'username': 1, 'email': 1, 'profile.nickname': 1}
+        for member in db.members.find({'username_lower': {'$exists': False}}, fields):
+            member = Member.normalize(member)
+            shadow = dict((field, member[field]) for field in LOWER_FIELDS if field in member)
+            if shadow:
+                bulk.find({'_id': member['_id']}).update_one({'$set': shadow})
+                total += 1
+        if total:
+            bulk.execute()
+        Member.ensure_indexes()
+        return total
 
-class Profile(object):
+    @staticmethod
+    def ensure_backfilled(lock_timeout=600):
+        """
+        Runs `backfill_lower` once, lookups and the search index only read
+        the shadow fields. Call it on startup before MemberIndex.ensure_built:
+        one process backfills under a lock, the others skip.
+        """
+        if rdb.exists(BACKFILLED):
+            return 0
+        if not rdb.set(BACKFILL_LOCK, 1, nx=True, ex=lock_timeout):
+            return 0
+        try:
+            total = Member.backfill_lower()
+            pipe = rdb.pipeline()
+            if total:
+                #an index built before the backfill misses these members
+                pipe.delete(MemberIndex.BUILT)
+            pipe.set(BACKFILLED, 1)
+            pipe.execute()
+            return total
+        finally:
+            rdb.delete(BACKFILL_LOCK)
+
+    @staticmethod
+    def get_top_topics_users(size=10, node_id=None, this_week=False):
+        """Members with the most topics, overall or in a node and/or this week."""
+        return PosterRanking.top(size, node_id, this_week)
+
+
+class Profile(CompactState):
+
+    _state = ('nickname', 'gender', 'avatar_url', 'signature', 'points', 'usable_points',
+              'birth_date', 'homepage', 'location', 'contact')
+    __slots__ = _state
 
     def __init__(self, profile=None):
         self.nickname = profile.get('nickname', '')
@@ -257,7 +366,10 @@ class Profile(object):
         )
 
 
-class Settings(object):
+class Settings(CompactState):
+
+    _state = ('time_zone', 'show_nickname', 'show_signature')
+    __slots__ = _state
 
     def __init__(self, settings=None):
         self.time_zone = settings.get('time_zone', 'Asia/Shanghai')
@@ -271,3 +383,11 @@ class Settings(object):
             show_signature=self.show_signature
         )
 
+
+register_codec(18, Member)
+register_codec(19, Profile)
+register_codec(20, Settings)
+
+
+if __name__ == '__main__':
+    print '... %d members backfilled ...' % Member.backfill_lower()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from webgear5.settings import db, rdb
+
+
+class MemberIndex(object):
+    """
+    Member search index in Redis. For each field the lowercase terms are
+    kept in a hash {username: term}, in a lexicographic sorted set of
+    'term\\0username' entries for exact and prefix matches, and in one set
+    of usernames per 3 letter gram for substring matches. Queries shorter
+    than a gram only match exact and prefix, every kind of match reads at
+    most `LIMIT` candidates per field.
+    """
+
+    FIELDS = ('username', 'nickname', 'email')
+    GRAM = 3
+    LIMIT = 200
+    BUILT = 'members:index:built'
+    LOCK = 'members:index:lock'
+
+    @staticmethod
+    def _terms(field):
+        return 'members:terms:%s' % field
+
+    @staticmethod
+    def _lex(field):
+        return 'members:lex:%s' % field
+
+    @staticmethod
+    def _gram(field, gram):
+        return u'members:gram:%s:%s' % (field, gram)
+
+    @staticmethod
+    def grams(term):
+        return set(term[i:i + MemberIndex.GRAM] for i in range(len(term) - MemberIndex.GRAM + 1))
+
+    @staticmethod
+    def _member_terms(member):
+        """{field: lowercase term} of a member document normalized by Member.normalize."""
+        values = (member.get('username_lower'), member.get('nickname_lower'), member.get('email_lower'))
+        return dict((field, value) for field, value in zip(MemberIndex.FIELDS, values) if value)
+
+    @staticmethod
+    def _write(pipe, field, username, old, new):
+        if old == new:
+            return
+        if old:
+            pipe.zrem(MemberIndex._lex(field), u'%s\0%s' % (old, username))
+            for gram in MemberIndex.grams(old):
+                pipe.srem(MemberIndex._gram(field, gram), username)
+            pipe.hdel(MemberIndex._terms(field), username)
+        if new:
+            pipe.zadd(MemberIndex._lex(field), 0, u'%s\0%s' % (new, username))
+            for gram in MemberIndex.grams(new):
+                pipe.sadd(MemberIndex._gram(field, gram), username)
+            pipe.hset(MemberIndex._terms(field), username, new)
+
+    @staticmethod
+    def add(member):
+        """Indexes a member document after it was written, replacing its previous terms."""
+        username = member.get('username')
+        if not username:
+            return
+        terms = MemberIndex._member_terms(member)
+        pipe = rdb.pipeline(transaction=False)
+        for field in MemberIndex.FIELDS:
+            pipe.hget(MemberIndex._terms(field), username)
+        old = pipe.execute()
+
+        pipe = rdb.pipeline()
+        for field, old_term in zip(MemberIndex.FIELDS, old):
+            MemberIndex._write(pipe, field, username, old_term and old_term.decode('utf-8'), terms.get(field))
+        pipe.execute()
+
+    @staticmethod
+    def remove(username):
+        MemberIndex.add({'username': username})
+
+    @staticmethod
+    def search(query, fields=FIELDS, page=1, size=20):
+        """
+        Returns (usernames, total, truncated) of the members whose fields
+        contain `query`, exact matches first, then prefix and substring
+        matches, each group in alphabetical order. At most `LIMIT`
+        candidates are read per field and kind of match, and queries shorter
+        than a gram only match exact and prefix. `truncated` tells that more
+        members may match than `total` counts.
+        """
+        if isinstance(query, str):
+            query = query.decode('utf-8', 'ignore')
+        query = query.lower()
+        if not query:
+            return [], 0, False
+
+        #lex ranges compare bytes, '\xff' sorts after any utf-8 continuation
+        prefix_key = query.encode('utf-8')
+        pipe = rdb.pipeline(transaction=False)
+        for field in fields:
+            pipe.zrangebylex(MemberIndex._lex(field), '[' + prefix_key, '[' + prefix_key + '\xff',
+                             start=0, num=MemberIndex.LIMIT)
+        grams = MemberIndex.grams(query)
+        for field in fields:
+            if len(grams) == 1:
+                #a single gram set can be large, it is scanned up to the limit
+                pipe.sscan(MemberIndex._gram(field, query), 0, count=MemberIndex.LIMIT)
+            elif grams:
+                pipe.sinter([MemberIndex._gram(field, gram) for gram in grams])
+        results = pipe.execute()
+        prefixed, contained = results[:len(fields)], results[len(fields):]
+
+        truncated = len(query) < MemberIndex.GRAM
+        exact, prefix, substring = set(), set(), set()
+        for entries in prefixed:
+            truncated = truncated or len(entries) >= MemberIndex.LIMIT
+            for entry in entries:
+                term, username = entry.decode('utf-8').split(u'\0', 1)
+                (exact if term == query else prefix).add(username)
+
+        if grams:
+            candidates = []
+            for field, found in zip(fields, contained):
+                if len(grams) == 1:
+                    truncated = truncated or int(found[0]) != 0
+                    found = found[1]
+                truncated = truncated or len(found) > MemberIndex.LIMIT
+                candidates.append((field, [member.decode('utf-8') for member in list(found)[:MemberIndex.LIMIT]]))
+            if len(grams) > 1:
+                #grams of a long query can match apart from each other, the terms are checked
+                pipe = rdb.pipeline(transaction=False)
+                for field, usernames in candidates:
+                    pipe.hmget(MemberIndex._terms(field), usernames or [''])
+                for (field, usernames), terms in zip(candidates, pipe.execute()):
+                    substring.update(username for username, term in zip(usernames, terms)
+                                     if term and query in term.decode('utf-8'))
+            else:
+                for field, usernames in candidates:
+                    substring.update(usernames)
+
+        prefix -= exact
+        substring -= exact | prefix
+        ranked = sorted(exact) + sorted(prefix) + sorted(substring)
+        return ranked[(page - 1) * size:page * size], len(ranked), truncated
+
+    @staticmethod
+    def ensure_built(lock_timeout=600):
+        """
+        Builds the index if it was never built. Call it on startup, not
+        while serving: one process rebuilds under a lock, the others skip.
+        """
+        if rdb.exists(MemberIndex.BUILT):
+            return 0
+        if not rdb.set(MemberIndex.LOCK, 1, nx=True, ex=lock_timeout):
+            return 0
+        try:
+            return MemberIndex.rebuild()
+        finally:
+            rdb.delete(MemberIndex.LOCK)
+
+    @staticmethod
+    def rebuild():
+        """
+        Brings every member's entries up to date and removes the entries of
+        members that are gone. Entries are replaced one member at a time, so
+        searches running meanwhile still see a complete index.
+        """
+        indexed = dict((field, dict((username.decode('utf-8'), term.decode('utf-8')) for username, term
+                                    in rdb.hgetall(MemberIndex._terms(field)).iteritems()))
+                       for field in MemberIndex.FIELDS)
+
+        total = 0
+        pipe = rdb.pipeline(transaction=False)
+        fields = {'username': 1, 'username_lower': 1, 'email_lower': 1, 'nickname_lower': 1}
+        for member in db.members.find({}, fields):
+            username = member.get('username')
+            if not username:
+                continue
+            terms = MemberIndex._member_terms(member)
+            for field in MemberIndex.FIELDS:
+                MemberIndex._write(pipe, field, username, indexed[field].pop(username, None), terms.get(field))
+            total += 1
+            if total % 1000 == 0:
+                pipe.execute()
+
+        for field, leftover in indexed.iteritems():
+            for username, term in leftover.iteritems():
+                MemberIndex._write(pipe, field, username, term, None)
+        pipe.set(MemberIndex.BUILT, 1)
+        pipe.execute()
+
+        #sets of 1 and 2 letter grams were dropped from the index
+        for field in MemberIndex.FIELDS:
+            for key in rdb.scan_iter(MemberIndex._gram(field, '*'), count=1000):
+                if len(key.decode('utf-8').split(u':', 3)[3]) < MemberIndex.GRAM:
+                    rdb.delete(key)
+        return total
+
+
+if __name__ == '__main__':
+    print '... %d members indexed ...' % MemberIndex.rebuild()
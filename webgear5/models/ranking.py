@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from webgear5.settings import db, rdb
+
+
+class PosterRanking(object):
+    """
+    Members ranked by number of topics in Redis sorted sets: overall, per
+    node and per week. Updated by Counter.topic_created/topic_deleted.
+    """
+
+    WEEKS = 5
+    BUILT = 'rank:topics:built'
+    LOCK = 'rank:topics:lock'
+
+    @staticmethod
+    def _key(node_id=None, week=None):
+        key = 'rank:topics'
+        if node_id:
+            key += ':node:%s' % node_id
+        if week:
+            key += ':week:%s' % week
+        return key
+
+    @staticmethod
+    def week(date=None):
+        """ISO year and week, a Monday to Sunday week keeps one key across new year"""
+        year, week, _ = (date or datetime.utcnow()).isocalendar()
+        return '%d%02d' % (year, week)
+
+    @staticmethod
+    def _keys(topic):
+        node_id = topic.get('node_id')
+        week = PosterRanking.week(topic.get('post_date'))
+        keys = [PosterRanking._key(), PosterRanking._key(week=week)]
+        if node_id:
+            keys.extend([PosterRanking._key(node_id), PosterRanking._key(node_id, week)])
+        return keys
+
+    @staticmethod
+    def add(topic, delta=1):
+        """Counts a created topic, `delta` -1 uncounts a deleted one."""
+        username = topic.get('username')
+        if not username:
+            return
+        pipe = rdb.pipeline(transaction=False)
+        for key in PosterRanking._keys(topic):
+            pipe.zincrby(key, username, delta)
+            if ':week:' in key:
+                pipe.expire(key, PosterRanking.WEEKS * 7 * 86400)
+        pipe.execute()
+
+    @staticmethod
+    def top(size=10, node_id=None, this_week=False):
+        """
+        Returns [{'_id': username, 'count': topics}], best first, empty
+        until `ensure_built` built the rankings.
+        """
+        key = PosterRanking._key(node_id, PosterRanking.week() if this_week else None)
+        ranking = rdb.zrevrange(key, 0, size - 1, withscores=True)
+        return [dict(_id=username, count=int(count)) for username, count in ranking if count > 0]
+
+    @staticmethod
+    def ensure_built(lock_timeout=600):
+        """
+        Builds the rankings if they were never built. Call it on startup, not
+        while serving: one process rebuilds under a lock, the others skip.
+        """
+        if rdb.exists(PosterRanking.BUILT):
+            return 0
+        if not rdb.set(PosterRanking.LOCK, 1, nx=True, ex=lock_timeout):
+            return 0
+        try:
+            return PosterRanking.rebuild()
+        finally:
+            rdb.delete(PosterRanking.LOCK)
+
+    @staticmethod
+    def rebuild():
+        """Recomputes the overall, per node and current week rankings from the topics."""
+        now = datetime.utcnow()
+        this_week = {'post_date': {'$gte': datetime(now.year, now.month, now.day) - timedelta(days=now.weekday())}}
+        week = PosterRanking.week(now)
+        rankings = {}
+
+        def group(key, match, name):
+            pipeline = [{'$group': {'_id': {'username': '$username', 'node_id': key}, 'n': {'$sum': 1}}}]
+            if match:
+                pipeline.insert(0, {'$match': match})
+            for row in db.topics.aggregate(pipeline)['result']:
+                username, node_id = row['_id'].get('username'), row['_id'].get('node_id')
+                if username and (node_id or key is None):
+                    rankings.setdefault(name(node_id), {})[username] = row['n']
+
+        group(None, None, lambda node_id: PosterRanking._key())
+        group('$node_id', None, lambda node_id: PosterRanking._key(node_id))
+        group(None, this_week, lambda node_id: PosterRanking._key(week=week))
+        group('$node_id', this_week, lambda node_id: PosterRanking._key(node_id, week))
+
+        pipe = rdb.pipeline()
+        for name, counts in rankings.iteritems():
+            pipe.delete(name)
+            for username, n in counts.iteritems():
+                pipe.zadd(name, n, username)
+            if ':week:' in name:
+                pipe.expire(name, PosterRanking.WEEKS * 7 * 86400)
+        pipe.set(PosterRanking.BUILT, 1)
+        pipe.execute()
+        return len(rankings)
+
+
+if __name__ == '__main__':
+    print '... %d rankings rebuilt ...' % PosterRanking.rebuild()
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import re
-from werkzeug.utils import cached_property
-from webgear5.extensions import mongo, cache
+from webgear5.settings import db, cache
+from webgear5.extensions.serializers import register_codec
+from webgear5.helpers import CompactState
 from pymongo import ASCENDING
+from .counter import Counter
 
 
-class Tag:
+class Tag(CompactState):
+
+    _state = ('id', 'tag_id', 'name', 'screen_name', 'description', 'followers')
+    __slots__ = _state
 
     def __init__(self, tag=None):
         self.id = tag['_id']
@@ -16,11 +21,11 @@ class Tag:
         self.description = tag['description']
         self.followers = tag['followers']
 
-    @cached_property
+    @property
     def total(self):
-        return mongo.db.topics.find({'tags': {'$in': [self.tag_id]}}).count()
+        return Tag.get_totals().get(self.tag_id, 0)
 
-    @cached_property
+    @property
     def json(self):
         return dict(
             tag_id=self.tag_id,
@@ -40,24 +45,43 @@ class Tag:
             description=self.description,
             followers=self.followers
         )
-        mongo.db.tags.save(tag)
+        db.tags.save(tag)
+        cache.delete_memoized(Tag.get_registry)
+
+    @staticmethod
+    @cache.memoize(timeout=24 * 60 * 60, local=True)
+    def get_registry():
+        tags = db.tags.find().sort('tag_id', ASCENDING)
+        return TagRegistry([Tag(tag) for tag in tags])
+
+    @staticmethod
+    @cache.memoize(timeout=10 * 60, local=True)
+    def get_totals():
+        """
+        Topic totals of all tags as {tag_id: total}, read from the tag counters
+        with one query. Missing counters are filled by a single aggregation.
+        """
+        tag_ids = Tag.get_registry().by_id.keys()
+        names = dict((Counter.tag_topics(tag_id), tag_id) for tag_id in tag_ids)
+        totals = Counter.get_many(names.keys(), Tag.count_totals)
+        return dict((names[name], total) for name, total in totals.iteritems())
+
+    @staticmethod
+    def count_totals():
+        """Counts the topics of every tag with one $unwind/$group, keyed by counter name"""
+        result = db.topics.aggregate([
+            {'$unwind': '$tags'},
+            {'$group': {'_id': '$tags', 'count': {'$sum': 1}}}
+        ])
+        return dict((Counter.tag_topics(row['_id']), row['count']) for row in result['result'])
 
     @staticmethod
-    @cache.memoize(timeout=24 * 60 * 60)
     def get_tags():
-        tags = mongo.db.tags.find().sort('tag_id', ASCENDING)
-        if tags.count() > 0:
-            return [Tag(tag) for tag in tags]
-        return None
+        return Tag.get_registry().tags or None
 
     @staticmethod
     def get_by_id(tag_id):
-        tags = Tag.get_tags()
-        if tags:
-            for tag in tags:
-                if tag.tag_id == tag_id:
-                    return tag
-        return None
+        return Tag.get_registry().by_id.get(tag_id)
 
     @staticmethod
     def get_json():
@@ -66,20 +90,33 @@ class Tag:
 
     @staticmethod
     def get_by_name(name):
-        tags = Tag.get_tags()
-        if tags:
-            for tag in tags:
-                if tag.name.lower() == name.lower():
-                    return tag
-        return None
+        return Tag.get_registry().by_name.get(name.lower())
 
     @staticmethod
     def get_by_screen_name(screen_name):
-        tags = Tag.get_tags()
-        if tags:
-            for tag in tags:
-                if tag.screen_name.lower() == screen_name.lower():
-                    return tag
-        return None
+        return Tag.get_registry().by_screen_name.get(screen_name.lower())
+
+
+class TagRegistry(CompactState):
+    """
+    All tags indexed by tag_id, lower case name and lower case screen_name.
+    It is memoized with a local tier, so every worker shares one instance
+    between requests until Tag.save invalidates it.
+    """
+
+    _state = ('tags',)
+    __slots__ = _state + ('by_id', 'by_name', 'by_screen_name')
+
+    def __init__(self, tags):
+        self.__setstate__((tags,))
+
+    def __setstate__(self, state):
+        CompactState.__setstate__(self, state)
+        self.tags = self.tags or []
+        self.by_id = dict((tag.tag_id, tag) for tag in self.tags)
+        self.by_name = dict((tag.name.lower(), tag) for tag in self.tags)
+        self.by_screen_name = dict((tag.screen_name.lower(), tag) for tag in self.tags)
 
 
+register_codec(21, Tag)
+register_codec(23, TagRegistry)
@@ -1,14 +1,18 @@
 import time
 from datetime import datetime, timedelta
-from pymongo import DESCENDING
-from werkzeug.utils import cached_property
-from webgear5.settings import db, cache, settings
+from pymongo import ASCENDING, DESCENDING
+from webgear5.settings import db, rdb, cache, page_cache, settings
+from webgear5.helpers import cached_property, set_cached, keyset_find, encode_cursor, CompactState
+from webgear5.extensions.serializers import register_codec
 from .favorite import Favorite
 from .member import Member
 from .tag import Tag
+from .counter import Counter
+from .view_counter import ViewCounter
+from .hot_topics import HotTopics
 
 
-class Topic:
+class Topic(CompactState):
 
     NORMAL = 0
     IMAGE = 1 << 0
@@ -16,6 +20,11 @@ class Topic:
     CHECKIN = 1 << 2
     LOCKED = 1 << 3
 
+    #topics keep only what Topic.json and the list templates need
+    _state = ('id', 'topic_id', 'subject', 'username', 'post_date', 'last_username',
+              'last_post_date', 'flags', 'views', 'replies', 'favorites', 'is_prime', 'tags')
+    __slots__ = _state + ('_cached',)
+
     def __init__(self, topic=None):
         self.id = topic.get('_id', '')
         self.topic_id = topic.get('topic_id', 0)
@@ -30,7 +39,6 @@ class Topic:
         self.favorites = topic.get('favorites', 0)
         self.is_prime = topic.get('is_prime', False)
         self.tags = topic.get('tags', [])
-        self.topic = topic
 
     @cached_property
     def member(self):
@@ -52,6 +60,19 @@ class Topic:
     def last_nickname(self):
         return self.last_member.nickname
 
+    @cached_property
+    def view_counts(self):
+        return ViewCounter.counts([self.topic_id]).get(self.topic_id, (0, 0))
+
+    @property
+    def total_views(self):
+        """
+        Stored views plus the ones not flushed to Mongo yet, a topic memoized
+        before the last flush counts the views stored by it
+        """
+        flushed, pending = self.view_counts
+        return max(self.views, flushed) + pending
+
     @property
     def is_locked(self):
         return self.flags & self.LOCKED == self.LOCKED
@@ -74,12 +95,8 @@ class Topic:
 
     @property
     def tag_names(self):
-        tags = []
-        for t in self.tags:
-            tag = Tag.get_by_id(t)
-            if tag:
-                tags.append(tag)
-        return tags
+        by_id = Tag.get_registry().by_id
+        return [by_id[t] for t in self.tags if t in by_id]
 
     @property
     def timestamp(self):
@@ -95,21 +112,28 @@ class Topic:
             post_date=self.post_date.isoformat(),
             last_username=self.last_username,
             last_post_date=self.last_post_date.isoformat(),
-            views=self.views,
+            views=self.total_views,
             replies=self.replies,
             favorites=self.favorites,
             is_prime=self.is_prime
         )
 
     def save(self):
-        self.topic['subject'] = self.subject
-        self.topic['flags'] = self.flags
-        self.topic['tags'] = self.tags
-        self.topic['is_prime'] = self.is_prime
-        self.topic['last_username'] = self.last_username
-        self.topic['last_post_date'] = self.last_post_date
-        self.topic['replies'] = self.replies
-        db.topics.save(self.topic)
+        old = db.topics.find_and_modify(
+            query={'_id': self.id},
+            update={'$set': dict(
+                subject=self.subject,
+                flags=self.flags,
+                tags=self.tags,
+                is_prime=self.is_prime,
+                last_username=self.last_username,
+                last_post_date=self.last_post_date,
+                replies=self.replies
+            )},
+            fields={'node_id': 1, 'username': 1, 'tags': 1, 'is_prime': 1}
+        )
+        if old:
+            Counter.topic_changed(old, dict(old, tags=self.tags, is_prime=self.is_prime))
 
     @staticmethod
     def get_topic(topic_id):
@@ -117,12 +141,11 @@ class Topic:
         return Topic(topic) if topic else None
 
     @staticmethod
-    def add_views(topic_id):
-        db.topics.find_and_modify(
-            query={'topic_id': topic_id},
-            update={'$inc': {'views': 1}},
-            new=True
-        )
+    def add_views(topic_id, node_id=None):
+        pipe = rdb.pipeline(transaction=False)
+        ViewCounter.add(topic_id, pipe=pipe)
+        HotTopics.record(topic_id, node_id, HotTopics.VIEW, pipe=pipe)
+        pipe.execute()
 
     @staticmethod
     def edit_flags(topic_id, flags=0, add=True):
@@ -142,13 +165,32 @@ class Topic:
                     db.topics.save(topic)
 
             cache.delete_memoized(Topics.get_topics)
+            page_cache.invalidate()
+
+    @staticmethod
+    def ensure_indexes():
+        """Compound indexes for the (sort, topic_id) order of Topics.find in every listing."""
+        order = [('last_post_date', DESCENDING), ('topic_id', DESCENDING)]
+        db.topics.ensure_index('topic_id')
+        db.topics.ensure_index(order, background=True)
+        db.topics.ensure_index([('node_id', ASCENDING)] + order, background=True)
+        db.topics.ensure_index([('tags', ASCENDING)] + order, background=True)
+        db.topics.ensure_index([('is_prime', ASCENDING)] + order, background=True)
+        db.topics.ensure_index([('node_id', ASCENDING), ('is_prime', ASCENDING)] + order, background=True)
+        db.topics.ensure_index([('username', ASCENDING), ('post_date', DESCENDING), ('topic_id', DESCENDING)],
+                               background=True)
 
 
-class Topics:
+class Topics(CompactState):
 
-    def __init__(self, topics, total=0):
+    _state = ('topics', 'total', 'next_cursor', 'prev_cursor')
+    __slots__ = _state
+
+    def __init__(self, topics, total=0, next_cursor=None, prev_cursor=None):
         self.topics = topics
         self.total = total
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
 
     @property
     def as_list(self):
@@ -156,99 +198,141 @@ class Topics:
 
     @property
     def json(self):
+        self.prefetch_views()
         return dict(
             topics=[topic.json for topic in self.topics],
-            total=self.total
+            total=self.total,
+            next_cursor=self.next_cursor,
+            prev_cursor=self.prev_cursor
         )
 
+    def prefetch_members(self):
+        """
+        Loads the authors and last posters of all topics with one batched
+        lookup instead of one Member.get_by_username per row.
+        """
+        if not self.topics:
+            return self
+
+        usernames = set()
+        for topic in self.topics:
+            usernames.add(topic.username)
+            usernames.add(topic.last_username)
+
+        members = Member.get_by_usernames(usernames)
+        for topic in self.topics:
+            set_cached(topic, 'member', members.get(topic.username))
+            set_cached(topic, 'last_member', members.get(topic.last_username))
+        return self
+
+    def prefetch_views(self):
+        """Reads the view counts of all topics with one Redis round trip"""
+        topics = [topic for topic in self.topics
+                  if 'view_counts' not in (getattr(topic, '_cached', None) or {})]
+        if not topics:
+            return self
+
+        counts = ViewCounter.counts(topic.topic_id for topic in topics)
+        for topic in topics:
+            set_cached(topic, 'view_counts', counts.get(topic.topic_id, (0, 0)))
+        return self
+
     @staticmethod
-    @cache.memoize()
-    def get_topics(node_id, page=1, size=50):
-        if node_id > 0:
-            t = db.topics.find({'node_id': node_id}) \
-                .sort('last_post_date', DESCENDING) \
-                .skip((page - 1) * size) \
-                .limit(size)
+    def find(query, page=1, size=50, cursor=None, sort='last_post_date', total=None):
+        """
+        One page of topics ordered by `sort`, newest first. With a `cursor`
+        (from next_cursor/prev_cursor of a previous page) the page starts
+        after that topic instead of skipping (page - 1) * size documents.
+        `total` is a Counter name or a known total, the query is only counted
+        when it is missing.
+        """
+        next_cursor = prev_cursor = None
+        if cursor:
+            docs, next_cursor, prev_cursor = keyset_find(db.topics, query, sort, 'topic_id', cursor, size)
         else:
-            t = db.topics.find() \
-                .sort('last_post_date', DESCENDING) \
+            docs = db.topics.find(query) \
+                .sort([(sort, DESCENDING), ('topic_id', DESCENDING)]) \
                 .skip((page - 1) * size) \
                 .limit(size)
 
-        if t.count(True) == 0:
+        topics = [Topic(topic) for topic in docs]
+        if not topics:
             return Topics(None, 0)
 
-        return Topics([Topic(topic) for topic in t], t.count())
+        if not cursor and len(topics) == size:
+            next_cursor = encode_cursor('n', getattr(topics[-1], sort), topics[-1].topic_id)
+
+        if isinstance(total, basestring):
+            total = Counter.get(total, lambda: db.topics.find(query).count())
+        elif total is None:
+            total = db.topics.find(query).count()
+        return Topics(topics, total, next_cursor, prev_cursor)
+
+    @staticmethod
+    @cache.memoize(single_flight=True)
+    def get_topics(node_id, page=1, size=50, cursor=None):
+        if node_id > 0:
+            return Topics.find({'node_id': node_id}, page, size, cursor, total=Counter.topics(node_id))
+        return Topics.find({}, page, size, cursor, total=Counter.topics())
 
     @staticmethod
     @cache.memoize()
-    def get_by_tag(tag_id, page=1, size=50):
-        t = db.topics.find({'tags': {'$in': [tag_id]}})\
-            .sort('last_post_date', DESCENDING)\
-            .skip((page - 1) * size)\
-            .limit(size)
-        if t.count(True) == 0:
-            return Topics(None, 0)
-        return Topics([Topic(topic) for topic in t], t.count())
+    def get_by_tag(tag_id, page=1, size=50, cursor=None):
+        return Topics.find({'tags': {'$in': [tag_id]}}, page, size, cursor, total=Counter.tag_topics(tag_id))
 
     @staticmethod
     @cache.memoize()
-    def get_primes(node_id, page=1, size=50):
+    def get_primes(node_id, page=1, size=50, cursor=None):
         if node_id > 0:
-            t = db.topics.find({'node_id': node_id, 'is_prime': True})\
-                .sort('last_post_date', DESCENDING)\
-                .skip((page - 1) * size)\
-                .limit(size)
-        else:
-            t = db.topics.find({'is_prime': True}) \
-                .sort('last_post_date', DESCENDING) \
-                .skip((page - 1) * size) \
-                .limit(size)
-
-        if t.count(True) == 0:
-            return Topics(None, 0)
-
-        return Topics([Topic(topic) for topic in t], t.count())
+            return Topics.find({'node_id': node_id, 'is_prime': True}, page, size, cursor,
+                               total=Counter.primes(node_id))
+        return Topics.find({'is_prime': True}, page, size, cursor, total=Counter.primes())
 
     @staticmethod
     @cache.memoize()
-    def get_favorites(username, page=1, size=50):
+    def get_favorites(username, page=1, size=50, cursor=None):
 
         favorite = Favorite.get_by_username(username)
         if favorite is None:
             return Topics(None, 0)
 
-        t = db.topics.find({'topic_id': {'$in': favorite.posts}}) \
-            .sort('last_post_date', DESCENDING) \
-            .skip((page - 1) * size) \
-            .limit(size)
-
-        if t.count(True) == 0:
-            return Topics(None, 0)
-
-        return Topics([Topic(topic) for topic in t], t.count())
+        return Topics.find({'topic_id': {'$in': favorite.posts}}, page, size, cursor, total=favorite.total)
 
     @staticmethod
-    def get_by_username(username, page=1, size=50):
-        t = db.topics.find({'username': username})\
-            .sort('post_date', DESCENDING)\
-            .skip((page - 1) * size)\
-            .limit(size)
-
-        if t.count(True) == 0:
-            return Topics(None, 0)
+    def get_by_username(username, page=1, size=50, cursor=None):
+        return Topics.find({'username': username}, page, size, cursor, sort='post_date',
+                           total=Counter.user_topics(username))
 
-        return Topics([Topic(topic) for topic in t], t.count())
+    @staticmethod
+    @cache.memoize(timeout=HotTopics.REFRESH)
+    def get_hot_topics(size=10, node_id=None):
+        topic_ids = HotTopics.top(size, node_id)
+        if not topic_ids:
+            return Topics.get_recent_hot_topics(size, node_id)
+
+        ranks = dict((topic_id, rank) for rank, topic_id in enumerate(topic_ids))
+        topics = sorted((Topic(topic) for topic in db.topics.find({'topic_id': {'$in': topic_ids}})),
+                        key=lambda topic: ranks[topic.topic_id])
+        if not topics:
+            return Topics(topics=None, total=0)
+        return Topics(topics, len(topics))
 
     @staticmethod
-    @cache.memoize(timeout=60 * 60)
-    def get_hot_topics(size=10):
-        delta = datetime.utcnow() - timedelta(days=7)
-        result = db.topics.find({'last_post_date': {'$gte': delta}})\
-            .sort([('replies', DESCENDING), ('views', DESCENDING)])\
-            .limit(size)
-
-        if result.count(True) == 0:
+    def get_recent_hot_topics(size=10, node_id=None):
+        """Hot topics from the last 7 days by replies and views, used while the leaderboard is empty"""
+        delta = datetime.utcnow() - timedelta(days=HotTopics.WINDOW)
+        query = {'last_post_date': {'$gte': delta}}
+        if node_id:
+            query['node_id'] = node_id
+        result = list(db.topics.find(query)
+                      .sort([('replies', DESCENDING), ('views', DESCENDING)])
+                      .limit(size))
+
+        if not result:
             return Topics(topics=None, total=0)
 
-        return Topics([Topic(topic) for topic in result], result.count())
+        return Topics([Topic(topic) for topic in result], len(result))
+
+
+register_codec(16, Topic)
+register_codec(17, Topics)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+import time
+import logging
+from redis.exceptions import ResponseError
+from webgear5.settings import db, rdb
+
+
+class ViewCounter(object):
+    """
+    Topic views are counted with HINCRBY in a Redis hash shared by all
+    workers and written to Mongo by `flush` as one bulk update. The views
+    stored by a flush are also kept in Redis for `FLUSHED_TIMEOUT` seconds,
+    so topics memoized before the flush do not lose the flushed views.
+    """
+
+    PENDING = 'topic:views'
+    FLUSHING = 'topic:views:flushing'
+    LOCK = 'topic:views:lock'
+    #longer than any memoized topic listing lives
+    FLUSHED_TIMEOUT = 600
+
+    @staticmethod
+    def _flushed(bucket):
+        return 'topic:views:flushed:%d' % bucket
+
+    @staticmethod
+    def add(topic_id, count=1, pipe=None):
+        (rdb if pipe is None else pipe).hincrby(ViewCounter.PENDING, topic_id, count)
+
+    @staticmethod
+    def counts(topic_ids):
+        """
+        Returns {topic_id: (stored views after the last flush or 0, views not
+        flushed yet)} with one round trip.
+        """
+        topic_ids = list(topic_ids)
+        if not topic_ids:
+            return {}
+        bucket = int(time.time() // ViewCounter.FLUSHED_TIMEOUT)
+        pipe = rdb.pipeline()
+        pipe.hmget(ViewCounter.PENDING, topic_ids)
+        pipe.hmget(ViewCounter.FLUSHING, topic_ids)
+        pipe.hmget(ViewCounter._flushed(bucket), topic_ids)
+        pipe.hmget(ViewCounter._flushed(bucket - 1), topic_ids)
+        pending, flushing, flushed, previous = pipe.execute()
+        return dict((topic_id, (max(int(c or 0), int(d or 0)), int(a or 0) + int(b or 0)))
+                    for topic_id, a, b, c, d in zip(topic_ids, pending, flushing, flushed, previous))
+
+    @staticmethod
+    def flush(lock_timeout=60):
+        """
+        Moves the pending views to Mongo, returns the number of updated
+        topics. The hash is renamed first so views counted meanwhile are
+        kept for the next flush, a flush interrupted by a crash is retried.
+        """
+        if not rdb.set(ViewCounter.LOCK, 1, nx=True, ex=lock_timeout):
+            return 0
+        try:
+            if not rdb.exists(ViewCounter.FLUSHING):
+                try:
+                    rdb.renamenx(ViewCounter.PENDING, ViewCounter.FLUSHING)
+                except ResponseError:
+                    #nothing was counted since the last flush
+                    return 0
+
+            views = rdb.hgetall(ViewCounter.FLUSHING)
+            pipe = rdb.pipeline()
+            if views:
+                bulk = db.topics.initialize_unordered_bulk_op()
+                for topic_id, count in views.iteritems():
+                    bulk.find({'topic_id': int(topic_id)}).update({'$inc': {'views': int(count)}})
+                bulk.execute()
+
+                #the stored totals replace the flushed pending views in one step
+                stored = db.topics.find({'topic_id': {'$in': [int(topic_id) for topic_id in views]}},
+                                        {'topic_id': 1, 'views': 1})
+                stored = dict((topic['topic_id'], topic.get('views', 0)) for topic in stored)
+                if stored:
+                    key = ViewCounter._flushed(int(time.time() // ViewCounter.FLUSHED_TIMEOUT))
+                    pipe.hmset(key, stored)
+                    pipe.expire(key, 2 * ViewCounter.FLUSHED_TIMEOUT)
+            pipe.delete(ViewCounter.FLUSHING)
+            pipe.execute()
+            return len(views)
+        except Exception:
+            logging.exception('Can not flush topic views.')
+            return 0
+        finally:
+            rdb.delete(ViewCounter.LOCK)
@@ -5,9 +5,11 @@ import redis
 import tornadoredis
 
 from pymongo import MongoClient
-from jinja2 import Environment, FileSystemLoader
 from extensions.session import RedisSessionStore
 from extensions.cache import Cache
+from extensions.page_cache import PageCache
+from extensions.templates import create_environment
+from helpers import LazyConnection
 
 root = os.path.dirname(__file__)
 
@@ -18,6 +20,11 @@ settings = dict(
     gzip=True,
     login_url='/account/login',
     template_path=os.path.join(root, 'templates'),
+    template_cache_path=os.path.join(root, '.template_cache'),
+    template_modules_path=os.path.join(root, '.template_modules'),
+    #characters of a page sent per flush, 0 renders it whole: a streamed page
+    #has no Etag, Content-Length or 304 and can not set cookies after the first flush
+    template_stream_buffer=0,
     static_path=os.path.join(root, 'static'),
     image_path=os.path.join(root, 'static/img'),
     js_path=os.path.join(root, 'static/js'),
@@ -25,31 +32,46 @@ settings = dict(
     session_lifetime=7,
     default_avatar_url='/static/img/avatar.jpg',
     avatar_prefix='/static/img/avatars/%s',
-    page_size=50
+    page_size=50,
+    views_flush_interval=60
 )
 
-#Jinja templates setting
-jinja_environment = Environment(
-    loader=FileSystemLoader(settings['template_path']),
-    auto_reload=settings['debug'],
+#Jinja templates setting, out of debug mode templates are not reloaded,
+#their bytecode is cached on disk and they are all loaded on startup
+jinja_environment = create_environment(
+    settings['template_path'],
+    debug=settings['debug'],
+    bytecode_cache_path=settings['template_cache_path'],
+    modules_path=settings['template_modules_path'],
     autoescape=False)
 
+#WebSocket-Redis pool, the db is selected by each tornadoredis.Client
+websocket_pool = LazyConnection(
+    lambda: tornadoredis.ConnectionPool(max_connections=500, wait_for_available=True))
+
 #Redis Session store
-pool = redis.ConnectionPool(db=0)
+pool = LazyConnection(lambda: redis.ConnectionPool(db=0))
 rdb = redis.StrictRedis(connection_pool=pool)
-session_store = RedisSessionStore(redis_connection=rdb)
-
-#WebSocket-Redis pool
-websocket_pool = tornadoredis.ConnectionPool(max_connections=500, wait_for_available=True, db=1)
+session_store = RedisSessionStore(redis_connection=rdb, async_pool=websocket_pool, db=0)
 
-#Database setting
-db = MongoClient('mongodb://localhost:27017')['webgear5']
-file_db = MongoClient('mongodb://localhost:27017')['webgear5']
+#Database setting, clients are opened on first use so that
+#every forked worker gets its own sockets
+db = LazyConnection(lambda: MongoClient('mongodb://localhost:27017')['webgear5'])
+file_db = LazyConnection(lambda: MongoClient('mongodb://localhost:27017')['webgear5'])
 
 config = dict(
     CACHE_REDIS_HOST='127.0.0.1',
     CACHE_REDIS_PORT=6379,
-    CACHE_KEY_PREFIX=''
+    CACHE_KEY_PREFIX='',
+    CACHE_ASYNC_POOL=websocket_pool
 )
 
 cache = Cache(config)
+page_cache = PageCache(cache)
+
+
+def init_connections():
+    """(Re)open the Mongo clients and Redis pools, called in each worker after fork"""
+    for conn in (pool, websocket_pool, db, file_db):
+        conn.reset()
+    cache.init_app()